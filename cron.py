@@ -25,7 +25,8 @@ from slib import tasks
 
 
 def main():
-    tasks.CleanupTask().run_async()
+    tasks.CleanupTask.schedule()
+    tasks.MirrorGCTask.schedule()
 
 
 if __name__ == '__main__':
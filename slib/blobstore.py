@@ -0,0 +1,151 @@
+## Copyright 2014 fs2mod-py authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import os
+import errno
+import hashlib
+import logging
+
+from .central import app
+
+# Every file is stored once in the blob directory (named by its SHA-256 hash) and all places which need it (mod
+# slugs, uploads) are hardlinks to that blob. This way identical files only take up space once and removing a slug
+# only removes references. A blob with a link count of 1 isn't used anymore.
+#
+# Since all links share the same content, nobody may change a linked file in place. Blobs are read-only and
+# release_tree() has to be called before anything writes into a directory which might contain links.
+BUFFER_SIZE = 1024 * 1024
+
+
+def enabled():
+    return app.config.get('MIRROR_DEDUPE', False) and app.config.get('MIRROR_PATH', None) is not None
+
+
+def blob_dir():
+    return os.path.join(app.config['MIRROR_PATH'], app.config.get('MIRROR_BLOB_PATH', '.blobs'))
+
+
+def blob_path(digest):
+    return os.path.join(blob_dir(), digest[:2], digest)
+
+
+def hash_file(path):
+    fhash = hashlib.new('sha256')
+    with open(path, 'rb') as stream:
+        while True:
+            chunk = stream.read(BUFFER_SIZE)
+            if not chunk:
+                break
+
+            fhash.update(chunk)
+
+    return fhash.hexdigest()
+
+
+def _replace_with_link(blob, path):
+    # Link next to the file and rename it over the file. This way the path never disappears.
+    tmp = os.path.join(os.path.dirname(path), '.link-' + os.path.basename(path))
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+
+    os.link(blob, tmp)
+    os.rename(tmp, path)
+
+
+def add(path, digest=None):
+    """
+    Stores the file at the given path in the blob store and returns True if it
+    was a duplicate (in that case the file has been replaced with a link to the
+    existing blob).
+    """
+    if digest is None:
+        digest = hash_file(path)
+
+    blob = blob_path(digest)
+    if not os.path.isdir(os.path.dirname(blob)):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+    if os.path.isfile(blob):
+        if os.path.samefile(blob, path):
+            return False
+
+        _replace_with_link(blob, path)
+        return True
+
+    try:
+        os.link(path, blob)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+        # Someone else stored the same file just now.
+        _replace_with_link(blob, path)
+        return True
+
+    # This changes the mode of all links.
+    os.chmod(blob, 0o444)
+    return False
+
+
+def link(digest, path):
+    """Creates the given path as a link to an existing blob. Returns False if there's no such blob."""
+    blob = blob_path(digest)
+    if not os.path.isfile(blob):
+        return False
+
+    _replace_with_link(blob, path)
+    return True
+
+
+def dedupe_tree(root):
+    """Adds all files below root to the blob store. Returns the number of bytes saved."""
+    saved = 0
+
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            fpath = os.path.join(path, name)
+            info = os.lstat(fpath)
+
+            # Files with more than one link are already part of the store.
+            if not os.path.isfile(fpath) or os.path.islink(fpath) or info.st_nlink > 1:
+                continue
+
+            try:
+                if add(fpath):
+                    saved += info.st_size
+            except OSError:
+                logging.exception('Failed to move %s into the blob store!', fpath)
+
+    return saved
+
+
+def release_tree(root):
+    """
+    Removes all links to blobs below root. Call this before writing into root
+    so the blobs (and all other links to them) keep their content. The files
+    have to be recreated afterwards.
+    """
+    removed = 0
+
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            fpath = os.path.join(path, name)
+            info = os.lstat(fpath)
+
+            if os.path.isfile(fpath) and not os.path.islink(fpath) and info.st_nlink > 1:
+                os.unlink(fpath)
+                removed += 1
+
+    return removed
@@ -0,0 +1,220 @@
+## Copyright 2014 fs2mod-py authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+import os.path
+import json
+import time
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from threading import Lock
+
+from .central import r, app
+from .util import canonical_hash
+
+# Successful conversions are stored in RESULTS (key -> JSON) and their last use is tracked in RESULTS_LRU. The oldest
+# entries are evicted once the cache grows beyond CONVERTER_CACHE_SIZE.
+RESULTS = 'conv_cache'
+RESULTS_LRU = 'conv_cache_lru'
+
+# File hashes are shared in the same way between all workers.
+HASHES = 'hash_cache'
+HASHES_LRU = 'hash_cache_lru'
+
+
+def _evict(name, lru, size, count):
+    if count > size:
+        evicted = r.zrange(lru, 0, count - size - 1)
+        if evicted:
+            logging.debug('Evicting %d entries from %s.', len(evicted), name)
+            pipe = r.pipeline()
+            pipe.hdel(name, *evicted)
+            pipe.zrem(lru, *evicted)
+            pipe.execute()
+
+
+def conversion_key(data):
+    # The output depends on the mirror settings so they have to be part of the key.
+    mirror_url = None
+    remove_prefixes = []
+    if app.config.get('MIRROR_PATH', None) is not None:
+        mirror_url = app.config.get('MIRROR_URL', None)
+        remove_prefixes.append(mirror_url)
+
+    return canonical_hash(data, mirror_url, remove_prefixes)
+
+
+def get_result(data):
+    if app.config.get('CONVERTER_CACHE_SIZE', 1000) < 1:
+        return None
+
+    key = conversion_key(data)
+    entry = r.hget(RESULTS, key)
+    if entry is None:
+        return None
+
+    entry = json.loads(entry.decode('utf8'))
+    now = time.time()
+    if now - entry['time'] > app.config.get('CONVERTER_CACHE_TTL', 24 * 60 * 60):
+        logging.debug('Expiring cached result %s.', key)
+        pipe = r.pipeline()
+        pipe.hdel(RESULTS, key)
+        pipe.zrem(RESULTS_LRU, key)
+        pipe.execute()
+        return None
+
+    r.zadd(RESULTS_LRU, now, key)
+    return entry['json']
+
+
+def store_result(data, result):
+    size = app.config.get('CONVERTER_CACHE_SIZE', 1000)
+    if size < 1:
+        return
+
+    key = conversion_key(data)
+    now = time.time()
+
+    pipe = r.pipeline()
+    pipe.hset(RESULTS, key, json.dumps({'json': result, 'time': now}))
+    pipe.zadd(RESULTS_LRU, now, key)
+    pipe.zcard(RESULTS_LRU)
+    _evict(RESULTS, RESULTS_LRU, size, pipe.execute()[-1])
+
+
+def remove_results(url):
+    """Removes every cached result which references a mirror file below the given URL."""
+    stale = []
+    for key, entry in r.hscan_iter(RESULTS, count=500):
+        if url in json.loads(entry.decode('utf8'))['json']:
+            stale.append(key)
+
+    if stale:
+        logging.debug('Removing %d cached results which reference %s.', len(stale), url)
+        pipe = r.pipeline()
+        pipe.hdel(RESULTS, *stale)
+        pipe.zrem(RESULTS_LRU, *stale)
+        pipe.execute()
+
+    return len(stale)
+
+
+class HashCache(MutableMapping):
+    """
+    A replacement for knossos.util.HASH_CACHE which survives between tasks.
+
+    Recently used entries are kept in memory, everything else is shared with
+    all other workers through Redis. Both levels evict the least recently used
+    entries once they're full. If a key is the path of an existing file, its
+    size and mtime become part of the key so a changed file never matches an
+    old entry.
+
+    Only files in the mirror (MIRROR_PATH) are shared. Everything else lives in
+    temporary directories which no other task will see again.
+    """
+    _lock = None
+    _local = None
+    _local_size = 0
+    _shared_size = 0
+    _mirror = None
+
+    def __init__(self, local_size=None, shared_size=None):
+        self._lock = Lock()
+        self._local = OrderedDict()
+        self._local_size = local_size if local_size is not None else app.config.get('HASH_CACHE_SIZE', 10000)
+        self._shared_size = shared_size if shared_size is not None else app.config.get('HASH_CACHE_SHARED_SIZE', 100000)
+
+        if app.config.get('MIRROR_PATH', None) is not None:
+            self._mirror = os.path.join(os.path.realpath(app.config['MIRROR_PATH']), '')
+
+    def _key(self, key):
+        if isinstance(key, str) and os.path.isfile(key):
+            info = os.stat(key)
+            return json.dumps((key, info.st_size, info.st_mtime))
+
+        return json.dumps(key)
+
+    def _is_shared(self, key):
+        return self._shared_size > 0 and self._mirror is not None and isinstance(key, str) and \
+            os.path.realpath(key).startswith(self._mirror)
+
+    def _remember(self, vkey, key, value):
+        with self._lock:
+            self._local[vkey] = (key, value)
+            self._local.move_to_end(vkey)
+
+            while len(self._local) > self._local_size:
+                self._local.popitem(last=False)
+
+    def __getitem__(self, key):
+        vkey = self._key(key)
+        with self._lock:
+            if vkey in self._local:
+                self._local.move_to_end(vkey)
+                return self._local[vkey][1]
+
+        if self._is_shared(key):
+            value = r.hget(HASHES, vkey)
+            if value is not None:
+                r.zadd(HASHES_LRU, time.time(), vkey)
+
+                value = json.loads(value.decode('utf8'))
+                if isinstance(value, list):
+                    # knossos stores tuples
+                    value = tuple(value)
+
+                self._remember(vkey, key, value)
+                return value
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        vkey = self._key(key)
+        self._remember(vkey, key, value)
+
+        if self._is_shared(key):
+            pipe = r.pipeline()
+            pipe.hset(HASHES, vkey, json.dumps(value))
+            pipe.zadd(HASHES_LRU, time.time(), vkey)
+            pipe.zcard(HASHES_LRU)
+            _evict(HASHES, HASHES_LRU, self._shared_size, pipe.execute()[-1])
+
+    def __delitem__(self, key):
+        vkey = self._key(key)
+        with self._lock:
+            self._local.pop(vkey, None)
+
+        if self._is_shared(key):
+            pipe = r.pipeline()
+            pipe.hdel(HASHES, vkey)
+            pipe.zrem(HASHES_LRU, vkey)
+            pipe.execute()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __iter__(self):
+        # Only the local entries can be listed.
+        with self._lock:
+            keys = [item[0] for item in self._local.values()]
+
+        return iter(keys)
+
+    def __len__(self):
+        return len(self._local)
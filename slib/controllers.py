@@ -15,14 +15,11 @@
 import logging
 import time
 import hashlib
-import os.path
-import tempfile
-import shutil
 
 from flask import request, json, jsonify, render_template
 
-from . import tasks
-from .central import app, r
+from . import tasks, taskqueue, registry, uploads
+from .central import app
 from knossos.util import str_random
 
 
@@ -41,19 +38,18 @@ def render_watcher(task_id):
     return render_template('watcher.html', task_id=task_id)
 
 
-@app.route('/drop/<int:t>/<token>/<int:kid>', methods=('POST', 'OPTIONS'))
-def receive_drop(t, token, kid):
-    if app.config.get('UPLOAD_PATH', None) is None or app.config.get('MIRROR_PATH', None) is None:
-        return 'Access denied', 403
+DROP_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Chunk-SHA256',
+    'Access-Control-Max-Age': '86400'
+}
 
-    headers = {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'POST, OPTIONS',
-        'Access-Control-Max-Age': '86400'
-    }
 
-    if request.method == 'OPTIONS':
-        return '', 200, headers
+def _check_drop_token(t, token, kid):
+    """Returns an error response if the upload token is invalid."""
+    if app.config.get('UPLOAD_PATH', None) is None or app.config.get('MIRROR_PATH', None) is None:
+        return 'Access denied', 403
 
     # Since this check only runs after the upload is completed, we have to take into account that uploading takes a
     # while. Allow up to half an hour of delay.
@@ -61,69 +57,216 @@ def receive_drop(t, token, kid):
         return jsonify(
             error=True,
             message='You took too long to upload!'
-        ), 200, headers
+        ), 200, DROP_HEADERS
 
     try:
         key = app.config['API_KEYS'][kid]
-    except KeyError:
-        return 'Access denied', 403, headers
+    except (KeyError, IndexError):
+        return 'Access denied', 403, DROP_HEADERS
 
     my_tk = hashlib.new('sha256')
     my_tk.update(('%s%d' % (key, t)).encode('utf8'))
     my_tk = my_tk.hexdigest()
     if my_tk != token:
-        return 'Access denied', 403, headers
+        return 'Access denied', 403, DROP_HEADERS
+
+    return None
+
+
+def _drop_url(digest):
+    return app.config['MIRROR_URL'] + '/' + app.config['UPLOAD_PATH'] + '/' + digest
+
+
+def _valid_upload_name(filename):
+    return filename != '' and '.' in filename and filename.rsplit('.', 1)[1] in app.config['UPLOAD_EXTENSIONS']
+
+
+@app.route('/drop/<int:t>/<token>/<int:kid>', methods=('POST', 'OPTIONS'))
+def receive_drop(t, token, kid):
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
+
+    error = _check_drop_token(t, token, kid)
+    if error:
+        return error
+
+    with uploads.UploadCollector(request):
+        if 'file' not in request.files:
+            digest = request.form.get('sha256', '').lower()
+            if digest == '':
+                return 'Access denied', 403, DROP_HEADERS
+
+            # The client only sent a hash. This only works if we already have the file.
+            if not uploads.is_stored(digest):
+                return jsonify(
+                    error=True,
+                    message='Unknown file, please upload it!'
+                ), 200, DROP_HEADERS
+
+            return jsonify(
+                error=False,
+                url=_drop_url(digest)
+            ), 200, DROP_HEADERS
+
+        file = request.files['file']
+        if not _valid_upload_name(file.filename):
+            return jsonify(
+                error=True,
+                message='Invalid filename!'
+            ), 200, DROP_HEADERS
+
+        # The file has already been hashed and written to the upload directory while it was received.
+        digest = file.stream.commit()
 
-    if 'file' not in request.files:
-        return 'Access denied', 403, headers
+    return jsonify(
+        error=False,
+        url=_drop_url(digest)
+    ), 200, DROP_HEADERS
+
+
+@app.route('/drop/<int:t>/<token>/<int:kid>/check/<sha256>', methods=('GET', 'OPTIONS'))
+def check_drop(t, token, kid, sha256):
+    """Tells the client whether it has to upload the file with the given hash."""
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
 
-    file = request.files['file']
-    if file.filename == '' or '.' not in file.filename or file.filename.rsplit('.', 1)[1] not in app.config['UPLOAD_EXTENSIONS']:
+    error = _check_drop_token(t, token, kid)
+    if error:
+        return error
+
+    sha256 = sha256.lower()
+    if uploads.is_stored(sha256):
+        return jsonify(
+            error=False,
+            exists=True,
+            url=_drop_url(sha256)
+        ), 200, DROP_HEADERS
+    else:
+        return jsonify(
+            error=False,
+            exists=False
+        ), 200, DROP_HEADERS
+
+
+# Chunked uploads: The client starts an upload with /init, sends the chunks (in any order and in parallel) with PUT
+# requests and completes the upload with /finish. If the connection breaks, the status tells it which chunks are missing.
+# Only /init needs a valid token, just like a normal drop. It returns an unguessable upload ID which authorizes all
+# following requests, so an upload can be resumed long after the token expired. If /init receives the hash of a file
+# we already have, it returns the file's URL right away.
+def _chunked_upload_info(upload):
+    return jsonify(
+        error=False,
+        upload_id=upload.id,
+        size=upload.info['size'],
+        chunk_size=upload.info['chunk_size'],
+        chunks=upload.info['chunks'],
+        missing=upload.missing()
+    )
+
+
+def _load_chunked_upload(upload_id):
+    if app.config.get('UPLOAD_PATH', None) is None or app.config.get('MIRROR_PATH', None) is None:
+        return None
+
+    return uploads.ChunkedUpload.load(upload_id)
+
+
+@app.route('/drop/<int:t>/<token>/<int:kid>/init', methods=('POST', 'OPTIONS'))
+def init_chunked_drop(t, token, kid):
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
+
+    error = _check_drop_token(t, token, kid)
+    if error:
+        return error
+
+    filename = request.form.get('filename', '')
+    if not _valid_upload_name(filename):
         return jsonify(
             error=True,
             message='Invalid filename!'
-        ), 200, headers
+        ), 200, DROP_HEADERS
 
-    fhash = hashlib.new('sha256')
-    fs = file.stream
-    buf = None
+    sha256 = request.form.get('sha256', '').lower()
+    if uploads.is_stored(sha256):
+        # No need to upload anything.
+        return jsonify(
+            error=False,
+            upload_id=None,
+            url=_drop_url(sha256)
+        ), 200, DROP_HEADERS
 
-    if not file.stream.seekable():
-        buf = tempfile.TemporaryFile()
+    try:
+        size = int(request.form.get('size', ''))
+        upload = uploads.ChunkedUpload.create(filename, size, kid, sha256)
+    except ValueError:
+        return jsonify(
+            error=True,
+            message='Invalid size!'
+        ), 200, DROP_HEADERS
+    except uploads.UploadError as exc:
+        return jsonify(
+            error=True,
+            message=str(exc)
+        ), 200, DROP_HEADERS
 
-        # This while loop is copy&pasted from below to avoid checking buf on every iteration
-        while True:
-            chunk = fs.read(32 * fhash.block_size)
-            if not chunk:
-                break
+    return _chunked_upload_info(upload), 200, DROP_HEADERS
 
-            fhash.update(chunk)
-            buf.write(chunk)
-    else:
-        while True:
-            chunk = fs.read(32 * fhash.block_size)
-            if not chunk:
-                break
-
-            fhash.update(chunk)
-
-    suffix = app.config['UPLOAD_PATH'] + '/' + fhash.hexdigest()
-    dst = os.path.join(app.config['MIRROR_PATH'], suffix)
-    
-    if not os.path.isfile(dst):
-        if buf is None:
-            file.stream.seek(0)
-            file.save(dst)
-        else:
-            with open(dst, 'wb') as stream:
-                shutil.copyfileobj(buf, stream)
-
-            buf.close()
+
+@app.route('/drop/upload/<upload_id>', methods=('GET', 'OPTIONS'))
+def get_chunked_drop(upload_id):
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
+
+    upload = _load_chunked_upload(upload_id)
+    if upload is None:
+        return 'Not found', 404, DROP_HEADERS
+
+    return _chunked_upload_info(upload), 200, DROP_HEADERS
+
+
+@app.route('/drop/upload/<upload_id>/<int:index>', methods=('PUT', 'OPTIONS'))
+def receive_chunk(upload_id, index):
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
+
+    upload = _load_chunked_upload(upload_id)
+    if upload is None:
+        return 'Not found', 404, DROP_HEADERS
+
+    try:
+        upload.write_chunk(index, request.stream, request.headers.get('X-Chunk-SHA256'))
+    except uploads.UploadError as exc:
+        return jsonify(
+            error=True,
+            message=str(exc)
+        ), 200, DROP_HEADERS
+
+    return jsonify(error=False), 200, DROP_HEADERS
+
+
+@app.route('/drop/upload/<upload_id>/finish', methods=('POST', 'OPTIONS'))
+def finish_chunked_drop(upload_id):
+    if request.method == 'OPTIONS':
+        return '', 200, DROP_HEADERS
+
+    upload = _load_chunked_upload(upload_id)
+    if upload is None:
+        return 'Not found', 404, DROP_HEADERS
+
+    try:
+        digest = upload.finish()
+    except uploads.UploadError as exc:
+        return jsonify(
+            error=True,
+            message=str(exc),
+            missing=upload.missing()
+        ), 200, DROP_HEADERS
 
     return jsonify(
         error=False,
-        url=app.config['MIRROR_URL'] + '/' + suffix
-    ), 200, headers
+        url=_drop_url(digest)
+    ), 200, DROP_HEADERS
 
 
 @app.route('/api/converter/request', methods=('POST',))
@@ -134,8 +277,17 @@ def conv_request():
 
     data = request.form.get('data', None)
     webhook = request.form.get('webhook', None)
+    priority = request.form.get('priority', taskqueue.default_priority())
     token = str_random(30)
 
+    if priority not in taskqueue.priorities():
+        return jsonify(
+            ticket=None,
+            token=None,
+            error=True,
+            message='Invalid priority!'
+        )
+
     try:
         data = json.loads(data)
     except ValueError:
@@ -146,7 +298,24 @@ def conv_request():
             error=True
         )
 
-    task_id = tasks.ConverterTask(data, webhook, token).run_async()
+    if request.form.get('refresh', '') not in ('1', 'true'):
+        task_id = tasks.ConverterTask.from_cache(data, webhook, token)
+        if task_id is not None:
+            return jsonify(
+                ticket=task_id,
+                token=token
+            )
+
+    # Levels are served in strict order so a key which could use any level would starve everyone below it.
+    levels = taskqueue.priorities()
+    highest = app.config.get('API_KEY_MAX_PRIORITY', {}).get(passwd, taskqueue.default_priority())
+    if highest in levels and levels.index(priority) < levels.index(highest):
+        priority = highest
+
+    # Tasks are scheduled fairly between API keys. We only use the key's index to identify it in Redis.
+    owner = 'key%d' % app.config['API_KEYS'].index(passwd)
+    weight = app.config.get('API_KEY_WEIGHTS', {}).get(passwd, 1)
+    task_id = tasks.ConverterTask.submit(data, webhook, token, priority, owner, weight)
 
     return jsonify(
         ticket=task_id,
@@ -157,14 +326,54 @@ def conv_request():
 @app.route('/api/converter/get_status/<int:task_id>')
 def conv_get_status(task_id):
     task = tasks.ConverterTask(id_=task_id)
-    return json.dumps(task.get_status())
+    status = task.get_status()
 
+    if 'follows' in status and status['state'] != 'DONE':
+        # This ticket shares its work with another task.
+        try:
+            task = tasks.ConverterTask(id_=status['follows'])
+            status = task.get_status()
+        except Exception:
+            # The other task is already gone, we'll be done in a moment.
+            status = dict(status, state='DONE')
 
-@app.route('/api/converter/retrieve', methods=('POST',))
-def conv_retrieve():
+        if status['state'] == 'DONE':
+            # The other task is done but hasn't updated our status yet.
+            status = dict(status, state='WORKING')
+
+    if status['state'] == 'WAITING':
+        status.update(task.get_queue_position() or {})
+
+    # The owner is an internal detail.
+    status.pop('queue', None)
+    return json.dumps(status)
+
+
+def _load_ticket():
     try:
-        task = tasks.ConverterTask(id_=request.form.get('ticket', None))
+        return tasks.ConverterTask(id_=request.form.get('ticket', None))
     except:
+        return None
+
+
+def _deliver_result(task, result):
+    if result['token'] != request.form.get('token'):
+        return ('Failed to validate token!', 403, [])
+
+    data = jsonify(
+        json=result['json'],
+        success=result['success'],
+        finished=True
+    )
+    task.remove()
+
+    return data
+
+
+@app.route('/api/converter/retrieve', methods=('POST',))
+def conv_retrieve():
+    task = _load_ticket()
+    if task is None:
         return jsonify(
             json=None,
             success=False,
@@ -180,26 +389,90 @@ def conv_retrieve():
             found=True
         )
 
-    result = task.get_result()
+    # Someone might have removed the task in the meantime. Blocking here would wait forever.
+    result = task.get_result(block=False)
+    if result is None:
+        return jsonify(
+            json=None,
+            success=False,
+            finished=True,
+            found=False
+        )
 
-    if result['token'] != request.form.get('token'):
+    return _deliver_result(task, result)
+
+
+@app.route('/api/converter/wait', methods=('POST',))
+def conv_wait():
+    # Works like retrieve but waits up to "timeout" seconds for the task to finish.
+    task = _load_ticket()
+    if task is None:
+        return jsonify(
+            json=None,
+            success=False,
+            finished=True,
+            found=False
+        )
+
+    try:
+        timeout = int(request.form.get('timeout', 30))
+    except ValueError:
+        timeout = 30
+
+    # Check the token first, otherwise anyone could tie up our threads.
+    valid = registry.check_token(task._str_id, request.form.get('token'))
+    if valid is False:
         return ('Failed to validate token!', 403, [])
 
-    data = jsonify(
-        json=result['json'],
-        success=result['success'],
-        finished=True
-    )
-    task.remove()
+    timeout = max(1, min(timeout, app.config.get('CONVERTER_WAIT_TIMEOUT', 60)))
+    # Tasks from older versions don't have a token so we can't check it before the result is there.
+    result = task.get_result(valid is True, timeout)
 
-    return data
+    if result is None:
+        return jsonify(
+            json=None,
+            success=False,
+            finished=False,
+            found=True
+        )
+
+    return _deliver_result(task, result)
 
 
 @app.route('/api/list_tasks')
 def list_tasks():
-    tasks = {}
-    for task in r.hkeys('task_status'):
-        task = task.decode('utf8')
-        tasks[task] = json.loads(r.hget('task_status', task))
-
-    return json.dumps(tasks)
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', 50))), 500)
+        since = request.args.get('since', None, type=float)
+        until = request.args.get('until', None, type=float)
+    except ValueError:
+        return 'Invalid parameters', 400
+
+    state = request.args.get('state', None)
+    if state is not None and state not in registry.STATES:
+        return 'Invalid state', 400
+
+    # The version changes whenever a task changes. Tasks also expire without changing the version so the tag only
+    # stays valid for a minute.
+    etag = '%d-%d-%s' % (registry.get_version(), time.time() // 60,
+                         hashlib.md5(request.query_string).hexdigest())
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    total, tasks = registry.query(state, since, until, offset, limit)
+    result = []
+    for task_id, info in tasks:
+        info['id'] = int(task_id)
+        result.append(info)
+
+    response = app.response_class(json.dumps({
+        'tasks': result,
+        'total': total,
+        'offset': offset,
+        'limit': limit
+    }), mimetype='application/json')
+    response.set_etag(etag)
+    return response
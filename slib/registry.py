@@ -0,0 +1,193 @@
+## Copyright 2014 fs2mod-py authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+import json
+import time
+import hmac
+import hashlib
+
+from .central import r, app
+
+# Every task stores its status in task_<id>_status and its result in task_<id>_result. Both keys expire on their own
+# (after TASK_LIFETIME or RESULT_LIFETIME once the task is done). All other keys of a task (task_<id><suffix>) get the
+# same expiry whenever the status changes.
+#
+# The sorted set INDEX contains all tasks scored by the time of their last state change and there's one sorted set per
+# state (task_state_<state>). These have to be pruned by the cleanup task since Redis can't expire set members.
+INDEX = 'task_index'
+# Incremented whenever the index changes.
+VERSION = 'task_index_version'
+# Every status change is published on this channel as {"id": <id>, "status": <status>}. Removed tasks are published as
+# {"id": <id>, "removed": true}.
+LIFECYCLE = 'task_lifecycle'
+STATES = ('WAITING', 'WORKING', 'DONE')
+KEY_SUFFIXES = ('_log', '_vlog', '_done', '_events', '_followers', '_fanout', '_fanout_progress', '_token')
+
+# A Lua function which other scripts can include to update a task's status.
+SET_STATUS_LUA = """
+local function set_status(id, status, state, time, ttl)
+    local prefix = 'task_' .. id
+
+    redis.call('SET', prefix .. '_status', status, 'EX', ttl)
+    redis.call('ZADD', '%(index)s', time, id)
+    for _, s in ipairs({%(states)s}) do
+        if s ~= state then
+            redis.call('ZREM', 'task_state_' .. s, id)
+        end
+    end
+    redis.call('ZADD', 'task_state_' .. state, time, id)
+
+    for _, suffix in ipairs({%(suffixes)s}) do
+        redis.call('EXPIRE', prefix .. suffix, ttl)
+    end
+
+    redis.call('INCR', '%(version)s')
+    redis.call('PUBLISH', '%(lifecycle)s', '{"id": ' .. id .. ', "status": ' .. status .. '}')
+end
+""" % {
+    'index': INDEX,
+    'version': VERSION,
+    'lifecycle': LIFECYCLE,
+    'states': ', '.join("'%s'" % s for s in STATES),
+    'suffixes': ', '.join("'%s'" % s for s in KEY_SUFFIXES)
+}
+
+_set_status_script = r.register_script(SET_STATUS_LUA + """
+set_status(ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+""")
+
+
+def status_key(task_id):
+    return 'task_%s_status' % task_id
+
+
+def result_key(task_id):
+    return 'task_%s_result' % task_id
+
+
+def lifetime(state):
+    return app.config['RESULT_LIFETIME'] if state == 'DONE' else app.config['TASK_LIFETIME']
+
+
+def set_status(task_id, info):
+    _set_status_script(args=[task_id, json.dumps(info), info['state'], info['time'], int(lifetime(info['state']))])
+
+
+def exists(task_id):
+    return r.exists(status_key(task_id))
+
+
+def get_status(task_id):
+    data = r.get(status_key(task_id))
+    if data is None:
+        return None
+
+    return json.loads(data.decode('utf8'))
+
+
+def get_statuses(task_ids):
+    """Returns a list of (id, status) tuples for the given tasks. Missing tasks are skipped."""
+    if len(task_ids) == 0:
+        return []
+
+    result = []
+    for task_id, data in zip(task_ids, r.mget([status_key(t) for t in task_ids])):
+        if data is not None:
+            result.append((task_id, json.loads(data.decode('utf8'))))
+
+    return result
+
+
+def save_result(task_id, data, pipe=None):
+    (pipe or r).set(result_key(task_id), json.dumps(data), ex=int(app.config['RESULT_LIFETIME']))
+
+
+def _hash_token(token):
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+def set_token(task_id, token):
+    """Remembers (a hash of) the token the client needs to retrieve the task's result."""
+    r.set('task_%s_token' % task_id, _hash_token(token), ex=int(app.config['TASK_LIFETIME']))
+
+
+def check_token(task_id, token):
+    """Returns True if the token is valid, False if it isn't and None if the task has no token."""
+    stored = r.get('task_%s_token' % task_id)
+    if stored is None:
+        return None
+
+    return token is not None and hmac.compare_digest(stored.decode('utf8'), _hash_token(token))
+
+
+def has_result(task_id):
+    return r.exists(result_key(task_id))
+
+
+def get_result(task_id):
+    data = r.get(result_key(task_id))
+    if data is None:
+        return None
+
+    return json.loads(data.decode('utf8'))
+
+
+def remove(task_id):
+    prefix = 'task_%s' % task_id
+    pipe = r.pipeline()
+    pipe.delete(status_key(task_id), result_key(task_id), *[prefix + suffix for suffix in KEY_SUFFIXES])
+    pipe.zrem(INDEX, task_id)
+    for state in STATES:
+        pipe.zrem('task_state_' + state, task_id)
+
+    pipe.incr(VERSION)
+    pipe.publish(LIFECYCLE, json.dumps({'id': int(task_id), 'removed': True}))
+    pipe.execute()
+
+
+def get_version():
+    return int(r.get(VERSION) or 0)
+
+
+def query(state=None, since=None, until=None, offset=0, limit=50):
+    """
+    Returns the newest tasks (optionally filtered by state and time) as a tuple
+    (total, [(id, status), ...]).
+    """
+    name = INDEX if state is None else 'task_state_' + state
+    low = '-inf' if since is None else since
+    high = '+inf' if until is None else until
+
+    pipe = r.pipeline(transaction=False)
+    pipe.zcount(name, low, high)
+    pipe.zrevrangebyscore(name, high, low, start=offset, num=limit)
+    total, task_ids = pipe.execute()
+
+    return total, get_statuses([task_id.decode('utf8') for task_id in task_ids])
+
+
+def prune(limit=500):
+    """Removes up to limit expired entries from each index. Returns the number of removed entries."""
+    now = time.time()
+    removed = 0
+    indexes = [(INDEX, max(lifetime('DONE'), lifetime('WAITING')))] + \
+        [('task_state_' + state, lifetime(state)) for state in STATES]
+
+    for name, ttl in indexes:
+        expired = r.zrangebyscore(name, '-inf', now - ttl, start=0, num=limit)
+        if expired:
+            r.zrem(name, *expired)
+            removed += len(expired)
+
+    return removed
@@ -0,0 +1,337 @@
+## Copyright 2014 fs2mod-py authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+import os
+import json
+import socket
+import logging
+from threading import Thread, Event
+
+from .central import r, app
+from knossos.util import str_random
+
+# Every priority level has one queue per owner (usually an API key) and a sorted set which contains all owners with
+# waiting tasks. The score of each owner is its "pass": Whenever one of its tasks is taken, the pass is increased by
+# 1 / weight and the owner with the lowest pass gets the next task (stride scheduling). This way a single owner can't
+# starve everyone else.
+#
+# Workers move every task they take into their own in-flight list and remove it only once the task is finished. If a
+# worker stops sending heartbeats, the reaper puts its in-flight tasks back on the queue.
+REQUEUE = 'task_requeue'
+SIGNAL = 'task_signal'
+WEIGHTS = 'task_weights'
+WORKERS = 'workers'
+WORKER_SLOTS = 'worker_slots'
+
+# The heartbeat thread reports on other workers and their tasks. The task log handlers ignore this logger so these
+# messages don't show up in the log of whichever task is running at the moment (see tasks.Task._owns_record).
+log = logging.getLogger(__name__)
+
+_push_script = r.register_script("""
+local queue, owners, vtime = KEYS[1], KEYS[2], KEYS[3]
+local entry, owner, weight, front = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+
+if front == '1' then
+    redis.call('RPUSH', queue, entry)
+else
+    redis.call('LPUSH', queue, entry)
+end
+
+redis.call('HSET', KEYS[4], owner, weight)
+if not redis.call('ZSCORE', owners, owner) then
+    -- New owners start at the current virtual time so they can't save up credit while they're idle.
+    redis.call('ZADD', owners, tonumber(redis.call('GET', vtime) or '0'), owner)
+end
+
+redis.call('LPUSH', KEYS[5], '1')
+redis.call('LTRIM', KEYS[5], 0, 99)
+""")
+
+_take_script = r.register_script("""
+for _, prio in ipairs(ARGV) do
+    local owners = 'task_owners_' .. prio
+
+    while true do
+        local head = redis.call('ZRANGE', owners, 0, 0, 'WITHSCORES')
+        if not head[1] then
+            break
+        end
+
+        local owner, pass = head[1], tonumber(head[2])
+        local queue = 'task_queue_' .. prio .. '_' .. owner
+        local entry = redis.call('RPOP', queue)
+
+        if entry then
+            redis.call('LPUSH', KEYS[1], entry)
+            redis.call('SET', 'task_vtime_' .. prio, pass)
+
+            if redis.call('LLEN', queue) == 0 then
+                redis.call('ZREM', owners, owner)
+            else
+                local weight = tonumber(redis.call('HGET', KEYS[2], owner) or '1')
+                redis.call('ZADD', owners, pass + 1 / weight, owner)
+            end
+
+            return entry
+        end
+
+        redis.call('ZREM', owners, owner)
+    end
+end
+
+return false
+""")
+
+_position_script = r.register_script("""
+local task_prefix, my_prio, my_owner = ARGV[1], ARGV[2], ARGV[3]
+local ahead = 0
+
+for i = 4, #ARGV do
+    local prio = ARGV[i]
+    local owners = redis.call('ZRANGE', 'task_owners_' .. prio, 0, -1, 'WITHSCORES')
+
+    if prio == my_prio then
+        local my_queue = redis.call('LRANGE', 'task_queue_' .. prio .. '_' .. my_owner, 0, -1)
+        local mine = nil
+
+        -- Tasks are taken from the right end.
+        for j = #my_queue, 1, -1 do
+            if string.sub(my_queue[j], 1, #task_prefix) == task_prefix then
+                mine = #my_queue - j
+                break
+            end
+        end
+
+        if not mine then
+            return -1
+        end
+
+        local my_pass = tonumber(redis.call('ZSCORE', 'task_owners_' .. prio, my_owner) or '0')
+        local my_weight = tonumber(redis.call('HGET', KEYS[1], my_owner) or '1')
+        local finish = my_pass + mine / my_weight
+        ahead = ahead + mine
+
+        for j = 1, #owners, 2 do
+            if owners[j] ~= my_owner then
+                local weight = tonumber(redis.call('HGET', KEYS[1], owners[j]) or '1')
+                local count = math.ceil((finish - tonumber(owners[j + 1])) * weight)
+                local queued = redis.call('LLEN', 'task_queue_' .. prio .. '_' .. owners[j])
+
+                ahead = ahead + math.max(0, math.min(count, queued))
+            end
+        end
+
+        return ahead
+    end
+
+    for j = 1, #owners, 2 do
+        ahead = ahead + redis.call('LLEN', 'task_queue_' .. prio .. '_' .. owners[j])
+    end
+end
+
+return -1
+""")
+
+
+def priorities():
+    return app.config.get('TASK_PRIORITIES', ('high', 'normal', 'low'))
+
+
+def default_priority():
+    return app.config.get('TASK_DEFAULT_PRIORITY', 'normal')
+
+
+def encode_entry(task_id, task_type, args, meta=None):
+    if meta is None:
+        meta = {'retries': 0}
+
+    return json.dumps((task_id, task_type, args, meta))
+
+
+def decode_entry(raw):
+    entry = json.loads(raw.decode('utf8', 'replace'))
+    if len(entry) < 4:
+        # Entry from an older version
+        entry.append({'retries': 0})
+
+    return entry
+
+
+def push(task_id, task_type, args, meta=None, front=False):
+    if meta is None:
+        meta = {'retries': 0}
+
+    prio = meta.setdefault('priority', default_priority())
+    if prio not in priorities():
+        log.warning('Task #%d has unknown priority "%s"! Using the default priority.', task_id, prio)
+        prio = meta['priority'] = default_priority()
+
+    owner = meta.setdefault('owner', 'system')
+    weight = meta.setdefault('weight', 1)
+
+    _push_script(keys=[
+        'task_queue_%s_%s' % (prio, owner),
+        'task_owners_' + prio,
+        'task_vtime_' + prio,
+        WEIGHTS,
+        SIGNAL
+    ], args=[encode_entry(task_id, task_type, args, meta), owner, weight, '1' if front else '0'])
+
+
+def position(task_id, prio, owner):
+    """Returns the number of tasks which will most likely start before the given task or None if it isn't queued."""
+    ahead = _position_script(keys=[WEIGHTS], args=['[%d,' % task_id, prio, owner] + list(priorities()))
+    if ahead < 0:
+        return None
+
+    return ahead
+
+
+def total_slots():
+    workers = [w for w in r.smembers(WORKERS)]
+    if len(workers) == 0:
+        return 0
+
+    return sum(int(n) for n in r.hmget(WORKER_SLOTS, workers) if n is not None)
+
+
+def reap(worker_id, on_requeue=None, on_abandon=None):
+    # Only one worker should look for dead workers at a time.
+    timeout = app.config.get('WORKER_HEARTBEAT_TIMEOUT', 60)
+    if not r.set('worker_reaper_lock', worker_id, nx=True, ex=timeout):
+        return
+
+    try:
+        # Finish what a previous reaper started.
+        _requeue_all(REQUEUE, on_requeue, on_abandon)
+
+        for worker in r.smembers(WORKERS):
+            worker = worker.decode('utf8')
+            if r.exists('worker_' + worker + '_alive'):
+                continue
+
+            log.warning('Worker %s stopped responding! Requeueing its tasks...', worker)
+            _requeue_all('worker_' + worker + '_inflight', on_requeue, on_abandon)
+            r.srem(WORKERS, worker)
+            r.hdel(WORKER_SLOTS, worker)
+    finally:
+        r.delete('worker_reaper_lock')
+
+
+def _requeue_all(inflight, on_requeue, on_abandon):
+    while True:
+        # Move the entry to a holding list first, this way nothing is lost if we die in the middle of this.
+        raw = r.rpoplpush(inflight, REQUEUE)
+        if raw is None:
+            break
+
+        _requeue(raw, REQUEUE, on_requeue, on_abandon)
+
+
+def _requeue(raw, holding, on_requeue, on_abandon):
+    """Puts the given entry back on the queue (or gives up on it) and removes it from the holding list."""
+    max_retries = app.config.get('TASK_MAX_RETRIES', 2)
+
+    try:
+        task_id, task_type, args, meta = decode_entry(raw)
+    except ValueError:
+        log.exception('Invalid JSON in list %s!', holding)
+        r.lrem(holding, 1, raw)
+        return
+
+    meta['retries'] = meta.get('retries', 0) + 1
+    if meta['retries'] > max_retries:
+        log.error('Task #%d failed %d times. Giving up.', task_id, meta['retries'])
+        if on_abandon:
+            on_abandon(task_id, task_type, args)
+    else:
+        log.info('Requeueing task #%d (attempt %d).', task_id, meta['retries'] + 1)
+        if on_requeue:
+            on_requeue(task_id, task_type, args, meta)
+
+        # Requeued tasks go to the front of the queue since they've been waiting for a while.
+        push(task_id, task_type, args, meta, front=True)
+
+    r.lrem(holding, 1, raw)
+
+
+class Consumer(object):
+    id = None
+    slots = 1
+    _inflight = None
+    _alive = None
+    _stop = None
+    _thread = None
+    _on_requeue = None
+    _on_abandon = None
+
+    def __init__(self, slots=1, on_requeue=None, on_abandon=None):
+        self.slots = slots
+        self.id = '%s:%d:%s' % (socket.gethostname(), os.getpid(), str_random(6))
+        self._inflight = 'worker_' + self.id + '_inflight'
+        self._alive = 'worker_' + self.id + '_alive'
+        self._stop = Event()
+        self._on_requeue = on_requeue
+        self._on_abandon = on_abandon
+
+    def start(self):
+        self._beat()
+        r.hset(WORKER_SLOTS, self.id, self.slots)
+        r.sadd(WORKERS, self.id)
+
+        self._thread = Thread(target=self._heartbeat)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+        # Normally the list is empty at this point but it doesn't hurt to make sure.
+        _requeue_all(self._inflight, self._on_requeue, self._on_abandon)
+        r.srem(WORKERS, self.id)
+        r.hdel(WORKER_SLOTS, self.id)
+        r.delete(self._alive)
+
+    def pop(self, timeout=5):
+        entry = self._take()
+        if entry is None:
+            # Wait until someone pushes a new task.
+            r.brpop(SIGNAL, timeout)
+            entry = self._take()
+
+        return entry
+
+    def _take(self):
+        return _take_script(keys=[self._inflight, WEIGHTS], args=list(priorities()))
+
+    def ack(self, raw):
+        r.lrem(self._inflight, 1, raw)
+
+    def requeue(self, raw):
+        """Puts a task we've taken back on the queue because it couldn't finish."""
+        _requeue(raw, self._inflight, self._on_requeue, self._on_abandon)
+
+    def _beat(self):
+        r.setex(self._alive, app.config.get('WORKER_HEARTBEAT_TIMEOUT', 60), '1')
+
+    def _heartbeat(self):
+        interval = app.config.get('WORKER_HEARTBEAT_TIMEOUT', 60) / 4
+
+        while not self._stop.wait(interval):
+            try:
+                self._beat()
+                reap(self.id, self._on_requeue, self._on_abandon)
+            except Exception:
+                log.exception('Heartbeat failed!')
@@ -15,31 +15,240 @@
 import os
 import json
 import time
+import math
 import logging
 import tempfile
 import re
 import shutil
-from urllib.parse import urlencode
+import functools
+from urllib.parse import urlencode, unquote
 from urllib.request import urlopen
-from threading import Lock
+from threading import Thread, Lock, Semaphore, Event, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import redis
 
 from .central import r, app
+from . import taskqueue, cache, registry, blobstore, uploads
 from .output import TaskLogHandler, MessagesFormatter
+from .util import canonical_hash
 
 os.environ['QT_API'] = 'headless'
 from knossos import progress, util
 import converter
 import converter.download
 
+# Keep file hashes between tasks. The cache is bounded so this doesn't leak memory.
+util.HASH_CACHE = cache.HashCache()
+
+# Tracks the task which is running in the current thread. This is necessary because a worker can run several tasks
+# at once (see Worker) and knossos only offers process-wide hooks.
+_context = local()
+
+# Set by the Worker if several tasks share this process.
+_shared_process = False
+
+
+
+def current_task():
+    return getattr(_context, 'task', None)
+
+
+# The router's thread serves every task in this process so its messages must not end up in a task's log.
+_inputs_log = logging.getLogger(__name__ + '.inputs')
+
+
+class InputRouter(object):
+    """
+    Receives the input messages of all tasks in this process.
+
+    Instead of subscribing to each task's input channel, we subscribe to the
+    pattern once and pass every message to the handlers registered for its
+    channel. This way each process only needs one connection and one thread
+    which blocks until a message arrives.
+    """
+    _lock = None
+    _handlers = None
+    _ready = None
+    _pid = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._handlers = {}
+
+    def add(self, channel, handler):
+        with self._lock:
+            self._handlers.setdefault(channel, []).append(handler)
+
+            if self._pid != os.getpid():
+                # Either we haven't started, yet, or we've been forked and the listener thread is gone.
+                self._pid = os.getpid()
+                self._ready = Event()
+
+                thread = Thread(target=self._listen)
+                thread.daemon = True
+                thread.start()
+
+        self._ready.wait(5)
+
+    def remove(self, channel, handler):
+        with self._lock:
+            self._handlers[channel].remove(handler)
+            if len(self._handlers[channel]) == 0:
+                del self._handlers[channel]
+
+    def _listen(self):
+        while True:
+            try:
+                p = r.pubsub(ignore_subscribe_messages=True)
+                p.psubscribe('task_*_input')
+                self._ready.set()
+
+                for msg in p.listen():
+                    channel = msg['channel'].decode('utf8')
+                    with self._lock:
+                        handlers = list(self._handlers.get(channel, ()))
+
+                    for handler in handlers:
+                        try:
+                            handler(msg)
+                        except Exception:
+                            _inputs_log.exception('Failed to handle a message on %s!', channel)
+            except redis.ConnectionError:
+                _inputs_log.exception('Lost the connection to Redis! Reconnecting in a second...')
+                time.sleep(1)
+
+
+_inputs = InputRouter()
+
+# Messages which don't belong to any task (see Task._owns_record).
+_worker_loggers = (taskqueue.log.name, _inputs_log.name)
+
+
+# Stores a log event and publishes it together with its sequence number (its position in the log, starting at 1).
+# Watchers use the sequence number to resume where they left off.
+_log_event_script = r.register_script("""
+local seq = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('PUBLISH', KEYS[2], string.sub(ARGV[1], 1, -2) .. ',' .. seq .. ']')
+""")
+
+
+# Errors which happen while writing task events must not reach the task's log handler since it would call us again.
+_events_log = logging.getLogger(__name__ + '.events')
+_events_log.propagate = False
+_events_log.addHandler(logging.StreamHandler())
+
+
+class EventBuffer(object):
+    """
+    Collects task events and writes them to Redis in pipelined batches.
+
+    A batch is written once it's full, after EVENT_FLUSH_INTERVAL seconds or
+    immediately if an event needs a quick reaction (see URGENT_EVENTS).
+    Batches are written one after another so watchers see the events in the
+    order they were emitted.
+    """
+    URGENT_EVENTS = ('done', 'captcha')
+    _lock = None
+    _flush_lock = None
+    _events = None
+    _wakeup = None
+    _pid = None
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._events = []
+
+    def add(self, task_id, name, args, log=True, key=None):
+        """Queues an event. Watchers only get the latest volatile (log=False) event for each key (defaults to name)."""
+        data = json.dumps((name, args))
+
+        with self._lock:
+            self._events.append((task_id, key or name, data, log))
+            full = len(self._events) >= app.config.get('EVENT_BATCH_SIZE', 100)
+
+            if self._pid != os.getpid():
+                # Start the flusher (again, if we've been forked).
+                self._pid = os.getpid()
+                self._wakeup = Event()
+
+                thread = Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+
+        if full or name in self.URGENT_EVENTS:
+            self.flush()
+        else:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                events = self._events
+                self._events = []
+
+            if len(events) == 0:
+                return
+
+            pipe = r.pipeline(transaction=False)
+            stream_mode = app.config.get('TASK_EVENT_STORE', 'list') == 'stream'
+            max_len = app.config.get('TASK_EVENT_STREAM_LENGTH', 10000)
+
+            touched = set()
+            for task_id, key, data, log in events:
+                if stream_mode:
+                    # Watchers read the stream directly so we don't need to publish anything.
+                    pipe.execute_command('XADD', 'task_' + task_id + '_events', 'MAXLEN', '~', max_len, '*',
+                                         'n', key, 'd', data, 'v', '0' if log else '1')
+                    touched.add('task_' + task_id + '_events')
+                    continue
+
+                if log:
+                    # Store all log messages.
+                    _log_event_script(keys=['task_' + task_id + '_log', 'task_' + task_id], args=[data], client=pipe)
+                    touched.add('task_' + task_id + '_log')
+                else:
+                    pipe.publish('task_' + task_id, data)
+                    pipe.hset('task_' + task_id + '_vlog', key, data)
+                    touched.add('task_' + task_id + '_vlog')
+
+            # Make sure these keys disappear even if the task never finishes.
+            for key in touched:
+                pipe.expire(key, int(app.config['TASK_LIFETIME']))
+
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                _events_log.exception('Failed to write %d task events!', len(events))
+
+    def _run(self):
+        interval = app.config.get('EVENT_FLUSH_INTERVAL', 0.1)
+        while True:
+            self._wakeup.wait()
+            # Give the task some time to emit more events.
+            time.sleep(interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_events = EventBuffer()
+
+
+def emit_event(task_id, name, args, log=True, key=None):
+    _events.add(task_id, name, args, log, key)
+
 
 class Task(object):
     _id = None
     _str_id = None
     _args = None
     _status = None
-    _p = None
-    _p_thread = None
     _listeners = None
+    _meta = None
+    # Set this in run() if the task will be finished by someone else.
+    _deferred = False
 
     def __init__(self, *args, id_=None):
         self._type = self.__class__.__name__
@@ -50,7 +259,7 @@ class Task(object):
             self._id = id_
             self._str_id = str(self._id)
 
-            if not r.hexists('task_status', self._str_id):
+            if not registry.exists(self._str_id):
                 raise Exception('Invalid task id specified!')
 
     def run(self):
@@ -69,32 +278,70 @@ class Task(object):
         finally:
             self._teardown()
 
+    def _input_channels(self):
+        return ['task_' + self._str_id + '_input']
+
     def _setup(self):
-        self._p = r.pubsub()
-        self._p.subscribe(**{'task_' + self._str_id + '_input': self._handle_message, 'ignore_subscribe_messages': True})
-        self._p_thread = self._p.run_in_thread(sleep_time=0.3)
+        for channel in self._input_channels():
+            _inputs.add(channel, self._handle_message)
 
+        _context.task = self
         self._h = TaskLogHandler(self, logging.INFO)
         self._h.setFormatter(MessagesFormatter('%(levelname)s: %(message)s'))
+        self._h.addFilter(self._owns_record)
         logging.getLogger().addHandler(self._h)
 
-        r.hset('task_status', self._str_id, json.dumps({'state': 'WORKING', 'time': time.time()}))
+        registry.set_status(self._str_id, {'state': 'WORKING', 'time': time.time()})
 
     def _teardown(self):
-        self._p_thread.stop()
-        self._p.unsubscribe('task_' + self._str_id + '_input')
+        for channel in self._input_channels():
+            _inputs.remove(channel, self._handle_message)
+
+        # Make sure our watchers see everything before the task is marked as done.
+        _events.flush()
+
+        if not self._deferred:
+            runtime = self._mark_done()
+            if runtime is not None:
+                self._update_avg_runtime(runtime)
+
+        logging.getLogger().removeHandler(self._h)
+        _context.task = None
 
+    def _mark_done(self):
         status = self.get_status(True)
         # Check if the task still exists. In some cases the task has already been
         # removed from Redis at this point.
-        if status:
-            now = time.time()
-            r.hset('task_status', self._str_id, json.dumps({'state': 'DONE', 'time': now, 'runtime': now - status['time']}))
+        if not status:
+            return None
 
-        logging.getLogger().removeHandler(self._h)
+        now = time.time()
+        runtime = now - status['time']
+        registry.set_status(self._str_id, {'state': 'DONE', 'time': now, 'runtime': runtime})
+        return runtime
+
+    def _update_avg_runtime(self, runtime):
+        # This is only used for estimates so we don't care about concurrent updates.
+        avg = r.hget('task_avg_runtime', self._type)
+        if avg is not None:
+            runtime = 0.8 * float(avg) + 0.2 * runtime
+
+        r.hset('task_avg_runtime', self._type, runtime)
+
+    def _owns_record(self, record):
+        # The filter runs in the thread which logged the record. If other tasks are running in this process, we only
+        # accept records from threads which belong to this task. The worker's own threads never log on behalf of a task.
+        if record.name in _worker_loggers:
+            return False
+
+        task = current_task()
+        if task is None:
+            return not _shared_process
+
+        return task is self
 
     def _handle_message(self, msg):
-        if msg['type'] == 'message':
+        if msg['type'] in ('message', 'pmessage'):
             try:
                 data = json.loads(msg['data'].decode('utf8'))
             except ValueError:
@@ -126,119 +373,259 @@ class Task(object):
         self.on(name, wrapper)
 
     def consume(self, name, timeout=3600):
-        r = None
+        result = None
+        received = Event()
 
         def wrapper(*data):
-            nonlocal r
-            r = data
+            nonlocal result
+            result = data
+            received.set()
 
         self.on(name, wrapper)
-        start = time.time()
-        while r is None and (time.time() - start) < timeout:
-            time.sleep(0.2)
+        received.wait(timeout)
 
         self.off(name, wrapper)
-        return r
+        return result
 
     def emit(self, name, *args, log=True):
-        data = json.dumps((name, args))
-        r.publish('task_' + self._str_id, data)
-
-        if log:
-            # Store all log messages.
-            r.rpush('task_' + self._str_id + '_log', data)
-        else:
-            r.hset('task_' + self._str_id + '_vlog', name, data)
+        emit_event(self._str_id, name, args, log)
 
     def wait_for_user(self, timeout=30):
         self.consume('user_ready', timeout)
 
     def save_result(self, data):
-        r.hset('task_result', self._str_id, json.dumps(data))
+        pipe = r.pipeline()
+        registry.save_result(self._str_id, data, pipe)
+        # Wake up everyone who's waiting in get_result().
+        pipe.lpush('task_' + self._str_id + '_done', '1')
+        pipe.expire('task_' + self._str_id + '_done', app.config['RESULT_LIFETIME'] + 60)
+        pipe.execute()
 
     # External API
 
-    def run_async(self):
-        self._id = r.incr('task_id')
-        self._str_id = str(self._id)
+    def run_async(self, priority=None, owner='system', weight=1):
+        if self._id is None:
+            self._id = r.incr('task_id')
+            self._str_id = str(self._id)
 
-        r.hset('task_status', self._str_id, json.dumps({'state': 'WAITING', 'time': time.time()}))
-        r.rpush('task_queue', json.dumps((self._id, self._type, self._args)))
+        if priority is None:
+            priority = taskqueue.default_priority()
+
+        registry.set_status(self._str_id, {
+            'state': 'WAITING',
+            'time': time.time(),
+            'queue': {'priority': priority, 'owner': owner}
+        })
+        taskqueue.push(self._id, self._type, self._args, {
+            'retries': 0,
+            'priority': priority,
+            'owner': owner,
+            'weight': weight
+        })
 
         return self._id
 
+    def requeued(self, meta):
+        # Called if the worker running this task died and the task was put back on the queue.
+        registry.set_status(self._str_id, {
+            'state': 'WAITING',
+            'time': time.time(),
+            'queue': {'priority': meta['priority'], 'owner': meta['owner']}
+        })
+        self.emit('log_message', 'WARNING: The worker running this task died. The task will be restarted.')
+
+    def abandon(self):
+        # Called if this task crashed its worker too many times.
+        self._mark_done()
+        self.emit('log_message', 'ERROR: The task crashed too many times. Giving up.')
+        self._fail()
+
+    def _fail(self):
+        self.emit('done', False)
+
     def get_status(self, update=False):
         if self._status is None or update:
-            data = r.hget('task_status', self._str_id)
+            data = registry.get_status(self._str_id)
             if data is not None:
-                self._status = json.loads(data.decode('utf8'))
+                self._status = data
 
         return self._status
 
-    def has_result(self):
-        return r.hexists('task_result', self._str_id)
+    def get_queue_position(self):
+        status = self.get_status()
+        if not status or status['state'] != 'WAITING' or 'queue' not in status:
+            return None
 
-    def get_result(self, block=True):
-        if block:
-            while not self.has_result():
-                time.sleep(0.3)
-        elif not self.has_result():
+        ahead = taskqueue.position(self._id, status['queue']['priority'], status['queue']['owner'])
+        if ahead is None:
             return None
 
-        return json.loads(r.hget('task_result', self._str_id).decode('utf8'))
+        # eta is the expected number of seconds until the task starts.
+        info = {'position': ahead + 1, 'eta': None}
+        runtime = r.hget('task_avg_runtime', self._type)
+        slots = taskqueue.total_slots()
+        if runtime is not None and slots > 0:
+            info['eta'] = ahead / slots * float(runtime)
+
+        return info
+
+    def has_result(self):
+        return registry.has_result(self._str_id)
+
+    def get_result(self, block=True, timeout=None):
+        data = registry.get_result(self._str_id)
+
+        if data is None and block:
+            # save_result() pushes to this list. We put the item back so that every waiter sees it.
+            done = 'task_' + self._str_id + '_done'
+            # BRPOPLPUSH only takes whole seconds and 0 means "wait forever".
+            timeout = 0 if timeout is None else max(1, int(math.ceil(timeout)))
+            if r.brpoplpush(done, done, timeout) is not None:
+                data = registry.get_result(self._str_id)
+
+        return data
 
     def remove(self):
-        r.hdel('task_status', self._str_id)
-        r.hdel('task_result', self._str_id)
-        r.delete('task_' + self._str_id + '_log')
-        r.delete('task_' + self._str_id + '_vlog')
+        registry.remove(self._str_id)
+
+
+def _execute_task(cls, args, id_, meta, isolated=False):
+    if isolated:
+        # We're running in a child process. Only the parent should react to Ctrl+C.
+        import signal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    task = cls(*args, id_=id_)
+    task._meta = meta
+    task._run_task()
 
 
 class Worker(object):
     _running = True
     _tasks = None
+    _slots = 1
+    _mode = 'thread'
 
-    def __init__(self):
+    def __init__(self, slots=None, mode=None):
         self._tasks = {}
+        self._slots = slots or app.config.get('WORKER_SLOTS', 1)
+        self._mode = mode or app.config.get('WORKER_MODE', 'thread')
+
+        if self._mode not in ('thread', 'process'):
+            raise ValueError('Unknown worker mode "%s"!' % self._mode)
 
     def register_task(self, cls):
         self._tasks[cls.__name__] = cls
 
     def run(self):
+        global _shared_process
         import signal
 
         signal.signal(signal.SIGINT, self.sig_quit)
 
         self._running = True
         logging.info('Registered tasks: %s', ', '.join(self._tasks.keys()))
+        logging.info('Running up to %d task(s) at once in %s mode.', self._slots, self._mode)
         logging.info('Ready and waiting for tasks.')
 
+        free_slots = Semaphore(self._slots)
+        isolated = self._mode == 'process'
+        if isolated:
+            pool = ProcessPoolExecutor(self._slots)
+        else:
+            _shared_process = self._slots > 1
+            pool = ThreadPoolExecutor(self._slots)
+
+        consumer = taskqueue.Consumer(self._slots, self._requeue_task, self._abandon_task)
+        consumer.start()
+        logging.info('Worker ID: %s', consumer.id)
+
+        def finished(future, task_id, raw):
+            exc = future.exception()
+            if isinstance(exc, BrokenProcessPool):
+                # A pool process died (i.e. it was killed by the OOM killer) so the task never finished.
+                logging.error('Task #%d was interrupted by a broken process pool!', task_id)
+                try:
+                    consumer.requeue(raw)
+                except Exception:
+                    # The entry is still in our in-flight list. The reaper will requeue it if we die.
+                    logging.exception('Failed to requeue task #%d!', task_id)
+            else:
+                consumer.ack(raw)
+
+                if exc is not None:
+                    logging.error('Task #%d crashed: %s', task_id, exc)
+                else:
+                    logging.info('Task #%d finished!', task_id)
+
+            free_slots.release()
+
         while self._running:
-            task = r.blpop('task_queue', timeout=5)
-            if not task:
+            # Only take a task from the queue if we can start it right away. Otherwise another worker might be able
+            # to process it sooner.
+            if not free_slots.acquire(timeout=5):
+                continue
+
+            raw = consumer.pop(timeout=5)
+            if not raw:
+                free_slots.release()
                 continue
 
             try:
-                task = json.loads(task[1].decode('utf8', 'replace'))
+                task = taskqueue.decode_entry(raw)
             except ValueError:
                 logging.exception('Invalid JSON in task queue!')
+                consumer.ack(raw)
+                free_slots.release()
                 continue
 
             if task[1] not in self._tasks:
                 logging.error('Unknown task type "%s"!', task[1])
+                consumer.ack(raw)
+                free_slots.release()
                 continue
 
             logging.info('Running task #%d of type %s...', task[0], task[1])
 
-            task = self._tasks[task[1]](*task[2], id_=task[0])
-            task._run_task()
+            args = (_execute_task, self._tasks[task[1]], task[2], task[0], task[3], isolated)
+            try:
+                future = pool.submit(*args)
+            except BrokenProcessPool:
+                logging.warning('The process pool is broken. Starting a new one...')
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(self._slots)
+                future = pool.submit(*args)
+
+            future.add_done_callback(functools.partial(finished, task_id=task[0], raw=raw))
+
+        logging.info('Waiting for running tasks...')
+        pool.shutdown(wait=True)
+        consumer.stop()
+        logging.info('Quitting...')
 
-            logging.info('Task finished!')
+    def _load_task(self, task_id, task_type, args):
+        if task_type not in self._tasks:
+            logging.error('Unknown task type "%s"!', task_type)
+            return None
 
-        logging.info('Quitting...')
+        try:
+            return self._tasks[task_type](*args, id_=task_id)
+        except Exception:
+            logging.exception('Failed to load task #%d!', task_id)
+            return None
+
+    def _requeue_task(self, task_id, task_type, args, meta):
+        task = self._load_task(task_id, task_type, args)
+        if task:
+            task.requeued(meta)
+
+    def _abandon_task(self, task_id, task_type, args):
+        task = self._load_task(task_id, task_type, args)
+        if task:
+            task.abandon()
 
     def sig_quit(self, a, b):
-        logging.info('I will shut down once the running task is finished!')
+        logging.info('I will shut down once the running tasks are finished!')
         self.quit()
 
     def quit(self):
@@ -246,55 +633,412 @@ class Worker(object):
 
 
 class CleanupTask(Task):
+    """
+    Removes expired entries from the task index and data which doesn't belong to any task.
+
+    Task keys expire on their own (see registry) so this is mostly a safety net.
+    The work is split into phases which walk the keyspace incrementally. The
+    current phase and its cursor are stored in Redis so each run continues
+    where the last one stopped once CLEANUP_TIME_BUDGET is used up.
+    """
+    PHASES = ('prune_index', 'stale_conversions', 'stale_keys', 'stale_uploads')
+
+    @classmethod
+    def schedule(cls):
+        # Don't queue another cleanup if the last one hasn't run, yet.
+        # The flag expires on its own in case the task gets lost.
+        if r.set('cleanup_pending', '1', nx=True, ex=5 * int(app.config.get('CLEANUP_INTERVAL', 60))):
+            return cls().run_async()
+
+        return None
 
     def run(self):
-        living_tasks = []
-        now = time.time()
+        deadline = time.time() + app.config.get('CLEANUP_TIME_BUDGET', 10)
+        batch = app.config.get('CLEANUP_BATCH_SIZE', 500)
+
+        try:
+            state = r.hgetall('cleanup_state')
+            phase = int(state.get(b'phase', 0)) % len(self.PHASES)
+            cursor = int(state.get(b'cursor', 0))
+            done = 0
+
+            # Run every phase at most once per run.
+            while done < len(self.PHASES) and time.time() < deadline:
+                cursor = getattr(self, '_' + self.PHASES[phase])(cursor, batch)
+                if cursor == 0:
+                    phase = (phase + 1) % len(self.PHASES)
+                    done += 1
+
+            r.hmset('cleanup_state', {'phase': phase, 'cursor': cursor})
+        finally:
+            r.delete('cleanup_pending')
+
+    def _find_missing(self, tasks):
+        pipe = r.pipeline(transaction=False)
+        for task in tasks:
+            pipe.exists(registry.status_key(task))
+
+        return [task for task, exists in zip(tasks, pipe.execute()) if not exists]
+
+    def _prune_index(self, cursor, batch):
+        removed = registry.prune(batch)
+        if removed > 0:
+            logging.debug('Removed %d expired index entries.', removed)
+
+        # Keep going until we've removed everything.
+        return 1 if removed > 0 else 0
+
+    def _stale_conversions(self, cursor, batch):
+        cursor, entries = r.hscan('conv_inflight', cursor, count=batch)
+        # submit() adds the entry before the task's status exists so we ignore new entries.
+        limit = time.time() - app.config.get('CLEANUP_GRACE', 5 * 60)
+        old = []
+        for digest, value in entries.items():
+            task, _, started = value.decode('utf8').partition(':')
+            if float(started or 0) < limit:
+                old.append((digest, task))
+
+        entries = old
+        stale = set(self._find_missing([task for digest, task in entries]))
+
+        if stale:
+            logging.debug('Removing stale conversion entries for tasks %s.', ', '.join(stale))
+            pipe = r.pipeline(transaction=False)
+            pipe.hdel('conv_inflight', *[digest for digest, task in entries if task in stale])
+            pipe.delete(*['task_' + task + '_followers' for task in stale])
+            pipe.execute()
+
+        return cursor
+
+    def _stale_keys(self, cursor, batch):
+        # Keys of tasks which no longer exist. Normally these expire on their own.
+        cursor, names = r.scan(cursor, match='task_*_*', count=batch)
+        keys = {}
+
+        for name in names:
+            name = name.decode('utf8')
+            parts = name.split('_', 2)
+            if parts[1].isdigit() and '_' + parts[2] in registry.KEY_SUFFIXES + ('_result',):
+                keys.setdefault(parts[1], []).append(name)
+
+        stale = self._find_missing(list(keys.keys()))
+        if stale:
+            logging.debug('Removing stale keys of tasks %s.', ', '.join(stale))
+            r.delete(*[name for task in stale for name in keys[task]])
+
+        return cursor
+
+    def _stale_uploads(self, cursor, batch):
+        # Temporary files of chunked uploads which were never finished.
+        removed = uploads.remove_stale(batch)
+        if removed > 0:
+            logging.debug('Removed %d abandoned uploads.', removed)
+
+        # Keep going until we've removed everything.
+        return 1 if removed >= batch else 0
+
+
+class MirrorGCTask(Task):
+    """
+    Finds (and optionally removes) files in MIRROR_PATH which nothing refers to anymore.
+
+    A sweep starts by collecting every mirror URL in the cached conversion
+    results, the results which haven't expired yet and the repositories
+    listed in MIRROR_GC_REPOS. Then the mirror is walked one directory at a
+    time. Each run only looks at MIRROR_GC_IO_BUDGET entries and the remaining
+    directories are kept in Redis, so the next run continues where this one
+    stopped. Unreferenced files are only touched once they're older than
+    MIRROR_GC_GRACE. They're just reported unless MIRROR_GC_DELETE is set.
+    """
+    PENDING = 'mirror_gc_pending'
+    STATE = 'mirror_gc_state'
+    REFS = 'mirror_gc_refs'
+    DIRS = 'mirror_gc_dirs'
+
+    @classmethod
+    def schedule(cls):
+        if app.config.get('MIRROR_PATH', None) is None:
+            return None
+
+        # A finished sweep keeps this key until MIRROR_GC_INTERVAL has passed. An unfinished one removes it so the
+        # next cron run continues the sweep.
+        if r.set(cls.PENDING, '1', nx=True, ex=int(app.config.get('MIRROR_GC_INTERVAL', 24 * 60 * 60))):
+            return cls().run_async(priority=taskqueue.priorities()[-1])
 
-        # Check for expired / stuck tasks.
-        for task in r.hkeys('task_status'):
-            task = task.decode('utf8')
+        return None
+
+    def run(self):
+        done = False
+
+        try:
+            if not r.exists(self.DIRS):
+                self._start()
+
+            if self._sweep(app.config.get('MIRROR_GC_IO_BUDGET', 5000)):
+                self._report()
+                done = True
+        finally:
+            # Unless the sweep is complete, the next cron run should continue (or retry) it.
+            if not done:
+                r.delete(self.PENDING)
+
+    def _start(self):
+        refs = self._collect_references()
+        logging.info('Starting a mirror sweep with %d references.', len(refs))
+
+        pipe = r.pipeline()
+        pipe.delete(self.REFS, self.STATE)
+        refs = list(refs)
+        for i in range(0, len(refs), 1000):
+            pipe.sadd(self.REFS, *refs[i:i + 1000])
+
+        pipe.hmset(self.STATE, {'started': time.time(), 'files': 0, 'bytes': 0})
+        pipe.rpush(self.DIRS, json.dumps(('', None)))
+        pipe.execute()
+
+    def _collect_references(self):
+        prefix = app.config['MIRROR_URL'].rstrip('/') + '/'
+        refs = set()
+
+        for name in r.scan_iter(match='task_*_result', count=500):
+            data = r.get(name)
+            if data is not None:
+                self._find_urls(json.loads(data.decode('utf8')), prefix, refs)
+
+        for key, entry in r.hscan_iter(cache.RESULTS, count=500):
+            self._find_urls(json.loads(entry.decode('utf8'))['json'], prefix, refs)
+
+        # If one of these fails, we'd miss references so we don't catch any errors here.
+        for repo in app.config.get('MIRROR_GC_REPOS', []):
+            if '://' in repo:
+                hdl = urlopen(repo)
+                data = hdl.read().decode('utf8')
+                hdl.close()
+            else:
+                with open(repo, 'r') as stream:
+                    data = stream.read()
+
+            self._find_urls(json.loads(data), prefix, refs)
+
+        return refs
+
+    def _find_urls(self, data, prefix, refs):
+        if isinstance(data, dict):
+            data = list(data.values())
+
+        if isinstance(data, (list, tuple)):
+            for item in data:
+                self._find_urls(item, prefix, refs)
+        elif isinstance(data, str):
+            if data.startswith(prefix):
+                path = unquote(data[len(prefix):].split('?', 1)[0].split('#', 1)[0])
+                refs.add(os.path.normpath(path))
+            elif data[:1] in ('{', '['):
+                # Results are stored as JSON strings.
+                try:
+                    self._find_urls(json.loads(data), prefix, refs)
+                except ValueError:
+                    pass
+
+    def _is_referenced(self, path, refs):
+        # A reference to a directory covers everything inside it.
+        while path not in ('', '.'):
+            if path in refs:
+                return True
+
+            path = os.path.dirname(path)
+
+        return False
+
+    def _is_prunable(self, rel, blobs, keep):
+        # Only slug directories may be removed, the blob store's shards are reused by blobstore.add().
+        rel = os.path.normpath(rel)
+        return rel not in ('', '.') + keep and not rel.startswith(blobs + os.sep)
+
+    def _sweep(self, budget):
+        """Checks the next directories until the budget is used up. Returns True once the sweep is complete."""
+        root = app.config['MIRROR_PATH']
+        blobs = app.config.get('MIRROR_BLOB_PATH', '.blobs')
+        limit = time.time() - app.config.get('MIRROR_GC_GRACE', 7 * 24 * 60 * 60)
+        delete = app.config.get('MIRROR_GC_DELETE', False)
+        refs = set(ref.decode('utf8') for ref in r.smembers(self.REFS))
+        found = 0
+
+        if delete and len(refs) == 0:
+            # This is most likely a configuration error. Better safe than sorry.
+            logging.warning('No references found, only reporting unreferenced files.')
+            delete = False
+        found_bytes = 0
+
+        # Never remove these directories even if they're empty. upload_dir() and blobstore.add() expect them to exist.
+        keep = (os.path.normpath(app.config['UPLOAD_PATH']), os.path.normpath(blobs))
+
+        while budget > 0:
+            item = r.lpop(self.DIRS)
+            if item is None:
+                break
+
+            # Each item is a directory and the last entry we checked in it (if we ran out of budget in there).
+            rel, after = json.loads(item.decode('utf8'))
+            path = os.path.join(root, rel)
             try:
-                info = json.loads(r.hget('task_status', task).decode('utf8'))
-
-                if 'time' not in info:
-                    logging.warning('Task #%s doesn\'t have a "time" field! Deleting it...', task)
-                    r.hdel('task_status', task)
-                elif info['state'] == 'DONE':
-                    if now - info['time'] > app.config['RESULT_LIFETIME']:
-                        logging.debug('Expiring task %s.', task)
-                        r.hdel('task_status', task)
-                    else:
-                        living_tasks.append(task)
-                elif now - info['time'] > app.config['TASK_LIFETIME']:
-                    logging.debug('Expiring task %s.', task)
-                    r.hdel('task_status', task)
+                entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+            except OSError:
+                logging.warning('Failed to list %s!', path)
+                continue
+
+            budget -= 1
+            total = len(entries)
+            if after is not None:
+                entries = [entry for entry in entries if entry.name > after]
+
+            subdirs = []
+            last = None
+
+            for entry in entries:
+                if budget <= 0:
+                    break
+
+                budget -= 1
+                last = entry.name
+                erel = os.path.join(rel, entry.name)
+                if entry.is_symlink():
+                    continue
+
+                if entry.is_dir():
+                    subdirs.append(json.dumps((erel, None)))
+                    continue
+
+                # Linking a file changes its ctime but not its mtime.
+                info = entry.stat()
+                if max(info.st_mtime, info.st_ctime) > limit:
+                    continue
+
+                if erel.startswith(blobs + os.sep):
+                    # Blobs are referenced through hardlinks (see blobstore).
+                    if info.st_nlink > 1:
+                        continue
+                elif self._is_referenced(erel, refs):
+                    continue
+
+                found += 1
+                found_bytes += info.st_size
+
+                if delete:
+                    logging.info('Removing %s (%d bytes)...', erel, info.st_size)
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        logging.exception('Failed to remove %s!', erel)
                 else:
-                    living_tasks.append(task)
-            except:
-                # Make sure we only skip the failed task and we don't want to delete it's data because it might still be running.
-                logging.exception('Failed to check task #' + task + ' !')
-                living_tasks.append(task)
-
-        # Check for orphans.
-        for task in r.hkeys('task_result'):
-            task = task.decode('utf8')
-            if task not in living_tasks:
-                logging.debug('Removing orphaned task result %s.', task)
-                r.hdel('task_result', task)
-
-        # Check for stale logs.
-        for name in r.keys('task_*_log'):
-            task = name.decode('utf8').split('_')[1]
-            if task not in living_tasks:
-                logging.debug('Removing stale log for task %s.', task)
-                r.delete('task_' + task + '_log')
-
-        for name in r.keys('task_*_vlog'):
-            task = name.decode('utf8').split('_')[1]
-            if task not in living_tasks:
-                logging.debug('Removing stale vlog for task %s.', task)
-                r.delete('task_' + task + '_vlog')
+                    logging.info('Unreferenced: %s (%d bytes)', erel, info.st_size)
+
+            if subdirs:
+                r.rpush(self.DIRS, *subdirs)
+
+            if entries and last != entries[-1].name:
+                # Continue with this directory first in the next run.
+                r.lpush(self.DIRS, json.dumps((rel, last if last is not None else after)))
+            elif total == 0 and delete and self._is_prunable(rel, blobs, keep) and \
+                    os.stat(path).st_mtime < limit:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    logging.exception('Failed to remove %s!', rel)
+
+        pipe = r.pipeline()
+        pipe.hincrby(self.STATE, 'files', found)
+        pipe.hincrby(self.STATE, 'bytes', found_bytes)
+        pipe.exists(self.DIRS)
+        return not pipe.execute()[-1]
+
+    def _report(self):
+        state = r.hgetall(self.STATE)
+        files = int(state.get(b'files', 0))
+        size = int(state.get(b'bytes', 0))
+
+        if app.config.get('MIRROR_GC_DELETE', False):
+            logging.info('Mirror sweep complete. Removed %d files (%d bytes).', files, size)
+        else:
+            logging.info('Mirror sweep complete. Found %d unreferenced files (%d bytes).', files, size)
+
+        r.delete(self.REFS)
+
+
+def call_webhook(url, ticket):
+    """Notifies the given webhook that the ticket is done. Returns True if the client cancelled the ticket."""
+    if re.match(r'^https?://(localhost|127\..*)', url):
+        logging.warning('Ignored the webhook because it points to localhost.')
+        return False
+
+    try:
+        hdl = urlopen(url, data=urlencode({'ticket': ticket}).encode('utf8'))
+        response = hdl.read().decode('utf8', 'replace').strip()
+        hdl.close()
+
+        if len(response) > 0 and '{' in response:
+            response = json.loads(response)
+            if isinstance(response, dict) and response.get('cancelled', False):
+                return True
+    except:
+        logging.exception('Webhook failed!')
+
+    return False
+
+
+class WebhookTask(Task):
+
+    def run(self):
+        url, ticket = self._args
+        if call_webhook(url, str(ticket)):
+            try:
+                ConverterTask(id_=ticket).remove()
+            except Exception:
+                pass
+
+
+def _report_progress(prog, text):
+    task = current_task()
+    if task is not None:
+        task.p_update(prog, text)
+
+
+def _ask_user(img_url):
+    task = current_task()
+    if task is None:
+        logging.error('Received a captcha outside of a task! Ignoring it.')
+        return None
+
+    return task.ask_user(img_url)
+
+
+# conv_inflight maps the hash of the converted data to "<task id>:<start time>".
+# Adds a follower to the task which is currently converting the given data (if any).
+_attach_script = r.register_script(registry.SET_STATUS_LUA + """
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if not entry then
+    return false
+end
+
+local primary = string.match(entry, '^(%d+)')
+
+redis.call('RPUSH', 'task_' .. primary .. '_followers', ARGV[2])
+local status = cjson.encode({state='WAITING', time=tonumber(ARGV[4]), follows=tonumber(primary)})
+set_status(ARGV[3], status, 'WAITING', ARGV[4], ARGV[5])
+return primary
+""")
+
+# Removes the task from the list of running conversions and returns all followers.
+_detach_script = r.register_script("""
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if entry and string.match(entry, '^(%d+)') == ARGV[2] then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+
+local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return followers
+""")
 
 
 class ConverterTask(Task):
@@ -309,33 +1053,299 @@ class ConverterTask(Task):
             self.emit('progress', prog, text, log=False)
             self.lu = now
 
+            if self._parent is not None:
+                self._report_fan_progress(prog, text)
+
     def p_wrap(self, cb):
-        progress.set_callback(self.p_update)
+        # cb might run in a different thread so we have to remember which task it belongs to.
+        _context.task = self
+        progress.set_callback(_report_progress)
         cb()
 
     def ask_user(self, img_url):
         with self._captcha_lock:
             _result = None
+            received = Event()
 
-            def cb(code):
+            def cb(code, task_id=None):
                 nonlocal _result
-                _result = code
+                # Responses sent to our parent carry the ID of the task which asked (see _handle_message).
+                if task_id is not None and task_id != self._id:
+                    return
 
-            self.once('captcha_response', cb)
-            self.emit('captcha', img_url, log=False)
+                _result = code
+                received.set()
 
-            while _result is None:
-                time.sleep(0.3)
+            self.on('captcha_response', cb)
+            try:
+                self.emit('captcha', img_url, self._id, log=False)
+                received.wait()
+            finally:
+                self.off('captcha_response', cb)
 
         logging.debug('Received captcha response: %s', _result)
         return _result
 
+    def _call_webhook(self):
+        if self._args[1] is not None and call_webhook(self._args[1], self._str_id):
+            # TODO: Is this still necessary?
+            self.remove()
+
+    def _fail(self):
+        self._finish(None, False)
+
+    @classmethod
+    def submit(cls, data, webhook, token, priority=None, owner='system', weight=1):
+        # If the same data is already being converted, we attach a new ticket to the running task instead of
+        # converting everything twice.
+        task = cls(data, webhook, token)
+        task._id = r.incr('task_id')
+        task._str_id = str(task._id)
+        digest = canonical_hash(data)
+        follower = json.dumps((task._id, webhook, token))
+        registry.set_token(task._id, token)
+
+        attach_args = [digest, follower, task._id, time.time(), int(registry.lifetime('WAITING'))]
+        primary = _attach_script(keys=['conv_inflight'], args=attach_args)
+        if primary is None and not r.hsetnx('conv_inflight', digest, '%d:%d' % (task._id, time.time())):
+            # Someone else was faster.
+            primary = _attach_script(keys=['conv_inflight'], args=attach_args)
+
+        if primary is not None:
+            logging.info('Attached ticket #%d to task #%s.', task._id, primary.decode('utf8'))
+            return task._id
+
+        return task.run_async(priority, owner, weight)
+
+    @classmethod
+    def from_cache(cls, data, webhook, token):
+        # Returns a finished ticket if we've already converted the same data recently.
+        result = cache.get_result(data)
+        if result is None:
+            return None
+
+        task = cls(data, webhook, token)
+        task._id = r.incr('task_id')
+        task._str_id = str(task._id)
+
+        registry.set_token(task._id, token)
+        task.save_result({
+            'json': result,
+            'success': True,
+            'token': token
+        })
+        # Emit the events first. Marking the task as done shortens the lifetime of its event keys.
+        task.emit('log_message', 'INFO: This data has been converted recently. Using the cached result.')
+        task.emit('done', True)
+        registry.set_status(task._str_id, {'state': 'DONE', 'time': time.time(), 'runtime': 0})
+
+        if webhook is not None:
+            WebhookTask(webhook, task._id).run_async()
+
+        return task._id
+
+    def _resolve_followers(self, data, success):
+        followers = _detach_script(keys=['conv_inflight', 'task_' + self._str_id + '_followers'],
+                                   args=[canonical_hash(self._args[0]), self._str_id])
+
+        for info in followers:
+            task_id, webhook, token = json.loads(info.decode('utf8'))
+            try:
+                task = ConverterTask(self._args[0], webhook, token, id_=task_id)
+            except Exception:
+                logging.warning('Ticket #%d vanished!', task_id)
+                continue
+
+            task.save_result({
+                'json': data,
+                'success': success,
+                'token': token
+            })
+            # The event has to be written before the status shortens the lifetime of the task's keys.
+            task.emit('done', success)
+
+            status = task.get_status(True)
+            if status:
+                now = time.time()
+                registry.set_status(task._str_id, {'state': 'DONE', 'time': now, 'runtime': now - status['time']})
+
+            task._call_webhook()
+
+    def _finish(self, data, success):
+        if success:
+            cache.store_result(self._args[0], data)
+
+        self.save_result({
+            'json': data,
+            'success': success,
+            'token': self._args[2]
+        })
+        self._resolve_followers(data, success)
+        self._call_webhook()
+        self.emit('done', success)
+
+        if self._parent is not None:
+            self._fan_in(data, success)
+
+    # Fan-out / fan-in
+    #
+    # If a repo contains several mods, every mod is converted by a separate child task. The parent stays in the
+    # WORKING state and the last child which finishes merges all results and finishes the parent. Every child stores
+    # its result in the parent's fanout hash since its own result might expire before the last sibling is done.
+
+    @property
+    def _parent(self):
+        return self._args[3] if len(self._args) > 3 else None
+
+    def _input_channels(self):
+        channels = super(ConverterTask, self)._input_channels()
+        if self._parent is not None:
+            # Captchas are forwarded to the parent's watchers so we have to listen for their responses, too.
+            channels.append('task_%d_input' % self._parent)
+
+        return channels
+
+    def _handle_message(self, msg):
+        if self._parent is not None and msg['channel'] == ('task_%d_input' % self._parent).encode('utf8'):
+            # Our siblings listen on the parent's channel, too. Only accept responses to our own captchas.
+            try:
+                name, args = json.loads(msg['data'].decode('utf8'))
+                ours = name == 'captcha_response' and args[1] == self._id
+            except (ValueError, TypeError, LookupError):
+                ours = False
+
+            if not ours:
+                return
+
+        super(ConverterTask, self)._handle_message(msg)
+
+    def emit(self, name, *args, log=True):
+        super(ConverterTask, self).emit(name, *args, log=log)
+
+        if self._parent is not None and name in ('log_message', 'captcha'):
+            if name == 'log_message':
+                args = ('[%s] %s' % (self._mod_label(), args[0]),)
+
+            # Several children might be waiting for a captcha so the parent's watchers need all of them.
+            key = 'captcha_' + self._str_id if name == 'captcha' else None
+            emit_event(str(self._parent), name, args, log, key)
+
+    def _mod_label(self):
+        try:
+            return self._args[0]['mods'][0]['id']
+        except (KeyError, IndexError, TypeError):
+            return '#' + self._str_id
+
+    def _report_fan_progress(self, prog, text):
+        key = 'task_%d_fanout' % self._parent
+        pipe = r.pipeline()
+        pipe.hset(key + '_progress', self._str_id, prog)
+        pipe.hvals(key + '_progress')
+        pipe.hget(key, 'total')
+        _, values, total = pipe.execute()
+
+        total = int(total or len(values))
+        prog = sum(float(v) for v in values) / max(total, 1)
+        emit_event(str(self._parent), 'progress', (prog, '[%s] %s' % (self._mod_label(), text)), log=False)
+
+    def _fan_out(self, info, mods):
+        key = 'task_' + self._str_id + '_fanout'
+        if r.exists(key):
+            # We've been restarted after our worker died. The children are already running.
+            logging.info('The mods of this repo are already being converted.')
+            self._deferred = True
+            return
+
+        meta = self._meta or {}
+        repo = {k: v for k, v in info.items() if k != 'mods'}
+        children = []
+        for mod in mods:
+            child = ConverterTask(dict(repo, mods=[mod]), None, self._args[2], self._id)
+            child._id = r.incr('task_id')
+            child._str_id = str(child._id)
+            children.append(child)
+
+        r.hmset(key, {
+            'args': json.dumps(self._args),
+            'children': json.dumps([child._id for child in children]),
+            'total': len(children),
+            'pending': len(children)
+        })
+
+        for child in children:
+            child.run_async(meta.get('priority'), meta.get('owner', 'system'), meta.get('weight', 1))
+
+        logging.info('Split the repo into %d tasks: %s', len(children), ', '.join('#' + c._str_id for c in children))
+        self._deferred = True
+
+    def _fan_in(self, data, success):
+        key = 'task_%d_fanout' % self._parent
+        pipe = r.pipeline()
+        pipe.hset(key, 'result_' + self._str_id, json.dumps({'json': data, 'success': success}))
+        pipe.hincrby(key, 'pending', -1)
+        if pipe.execute()[-1] > 0:
+            return
+
+        info = r.hgetall(key)
+        if not info:
+            logging.error('The parent task #%d vanished!', self._parent)
+            return
+
+        parent = ConverterTask(*json.loads(info[b'args'].decode('utf8')), id_=self._parent)
+        mods = []
+        merged = None
+        success = True
+
+        for child_id in json.loads(info[b'children'].decode('utf8')):
+            result = info.get(('result_%d' % child_id).encode('utf8'))
+            result = json.loads(result.decode('utf8')) if result else None
+
+            if not result or not result['success']:
+                success = False
+            elif success:
+                data = json.loads(result['json'])
+                if merged is None:
+                    merged = data
+
+                mods.extend(data.get('mods', [data]))
+
+            registry.remove(child_id)
+
+        if success:
+            merged['mods'] = mods
+            merged = json.dumps(merged)
+            parent.emit('progress', 1, 'Done', log=False)
+        else:
+            merged = None
+            parent.emit('log_message', 'ERROR: At least one mod failed to convert!')
+
+        r.delete(key, key + '_progress')
+        parent._finish(merged, success)
+        parent._mark_done()
+
+    def _get_mods(self, info):
+        try:
+            if 'mods' not in info and 'title' in info and 'id' in info:
+                return [info]
+            else:
+                return info['mods']
+        except (KeyError, TypeError):
+            return None
+
     def run(self):
         dl_path = None
         dl_link = None
         slug_path = None
+        new_slug = False
+        out_data = None
         self._captcha_lock = Lock()
-        converter.download.ASK_USER = self.ask_user
+        converter.download.ASK_USER = _ask_user
+
+        if app.config.get('CONVERTER_FANOUT', False) and self._parent is None:
+            mods = self._get_mods(self._args[0])
+            if mods is not None and len(mods) > 1:
+                self._fan_out(self._args[0], mods)
+                return
 
         try:
             with tempfile.TemporaryDirectory() as tdir:
@@ -344,12 +1354,10 @@ class ConverterTask(Task):
                 remove_prefixes = []
 
                 if app.config.get('MIRROR_PATH', None) is not None:
-                    info = self._args[0]
+                    mods = self._get_mods(self._args[0])
                     try:
-                        if 'mods' not in info and 'title' in info and 'id' in info:
-                            mods = [info]
-                        else:
-                            mods = info['mods']
+                        if mods is None:
+                            raise KeyError('mods')
 
                         if len(mods) == 1:
                             dl_slug = os.path.join(os.path.basename(mods[0]['id']), os.path.basename(mods[0]['version']))
@@ -363,6 +1371,10 @@ class ConverterTask(Task):
                         slug_path = os.path.join(dl_path, dl_slug)
                         if not os.path.isdir(slug_path):
                             os.makedirs(slug_path)
+                            new_slug = True
+                        elif os.path.isdir(blobstore.blob_dir()):
+                            # The converter would overwrite the shared files in place. Let it create new ones.
+                            blobstore.release_tree(slug_path)
                     except KeyError:
                         # We're missing some keys here, this will be logged later, too.
                         dl_path = None
@@ -373,16 +1385,11 @@ class ConverterTask(Task):
 
                     result = converter.generate_checksums(repo, output, self.p_wrap, dl_path, dl_link, dl_slug, remove_prefixes=remove_prefixes)
 
-                    # Clear the cache to prevent a memory leak.
-                    util.HASH_CACHE = {}
-
                     if result and os.path.isfile(output):
                         with open(output, 'r') as stream:
-                            self.save_result({
-                                'json': stream.read(),
-                                'success': True,
-                                'token': self._args[2]
-                            })
+                            out_data = stream.read()
+                    else:
+                        result = False
                 except ValueError as exc:
                     logging.exception('Failed to parse JSON data: %s', str(exc))
                     result = False
@@ -392,37 +1399,30 @@ class ConverterTask(Task):
                     logging.exception('Failed to perform conversion!')
                     result = False
 
-                if not result:
-                    if slug_path is not None:
+                if result and slug_path is not None and blobstore.enabled():
+                    # Replace files which we already have (i.e. from a previous version of this mod) with links.
+                    try:
+                        saved = blobstore.dedupe_tree(slug_path)
+                        if saved > 0:
+                            logging.info('Saved %d bytes by linking duplicate files.', saved)
+                    except OSError:
+                        logging.exception('Failed to deduplicate %s!', slug_path)
+
+                if not result and slug_path is not None:
+                    if new_slug:
                         logging.info('Cleaning up...')
                         try:
                             shutil.rmtree(slug_path)
                         except:
                             logging.exception('Failed!')
-
-                    self.save_result({
-                        'json': None,
-                        'success': False,
-                        'token': self._args[2]
-                    })
-                
-                if self._args[1] is not None:
-                    if re.match(r'^https?://(localhost|127\..*)', self._args[1]):
-                        logging.warning('Ignored the webhook because it points to localhost.')
                     else:
+                        # Earlier results might point to files which we've just replaced (or partially written).
                         try:
-                            hdl = urlopen(self._args[1], data=urlencode({'ticket': self._str_id}).encode('utf8'))
-                            response = hdl.read().decode('utf8', 'replace').strip()
-                            hdl.close()
-
-                            if len(response) > 0 and '{' in response:
-                                response = json.loads(response)
-                                if isinstance(response, dict) and response.get('cancelled', False):
-                                    # TODO: Is this still necessary?
-                                    self.remove()
-                        except:
-                            logging.exception('Webhook failed!')
+                            cache.remove_results(dl_link.rstrip('/') + '/' + dl_slug + '/')
+                        except redis.RedisError:
+                            logging.exception('Failed to remove cached results for %s!', dl_slug)
 
-                self.emit('done', result)
+                self._finish(out_data if result else None, bool(result))
         finally:
-            converter.download.ASK_USER = None
+            if not _shared_process:
+                converter.download.ASK_USER = None
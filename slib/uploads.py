@@ -0,0 +1,338 @@
+## Copyright 2014 fs2mod-py authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+
+import os
+import re
+import time
+import errno
+import binascii
+import hashlib
+import tempfile
+import logging
+
+from .central import app, r
+from . import blobstore
+
+# Uploads are written with large buffers to keep the number of syscalls low.
+BUFFER_SIZE = 1024 * 1024
+
+# The temporary files of all unfinished chunked uploads and the time of their last activity.
+CHUNKED_FILES = 'upload_chunked_files'
+
+
+def upload_dir():
+    return os.path.join(app.config['MIRROR_PATH'], app.config['UPLOAD_PATH'])
+
+
+def is_stored(digest):
+    """Returns True if we already have a file with the given SHA-256 hash."""
+    if not re.match(r'^[0-9a-f]{64}$', digest):
+        return False
+
+    dst = os.path.join(upload_dir(), digest)
+    if os.path.isfile(dst):
+        return True
+
+    # The mirror might have the file even though nobody uploaded it.
+    return blobstore.enabled() and blobstore.link(digest, dst)
+
+
+def store(path, digest):
+    """Moves the given file into the upload directory, named by its hash."""
+    dst = os.path.join(upload_dir(), digest)
+
+    if os.path.isfile(dst):
+        # We already have this file.
+        os.unlink(path)
+    else:
+        # mkstemp() only allows us to read the file but the web server has to serve it.
+        os.chmod(path, 0o644)
+        os.rename(path, dst)
+
+        if blobstore.enabled():
+            blobstore.add(dst, digest)
+
+
+class HashedUpload(object):
+    """
+    A file-like object which hashes everything written to it.
+
+    The data is written to a temporary file in the upload directory. Once the
+    upload is complete, commit() renames it to its SHA-256 hash, which is
+    atomic and doesn't copy anything since both names are on the same file
+    system.
+    """
+    path = None
+    size = 0
+    _file = None
+    _hash = None
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='.upload-', dir=upload_dir())
+        self._file = os.fdopen(fd, 'wb', BUFFER_SIZE)
+        self._hash = hashlib.new('sha256')
+
+    def write(self, data):
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def seek(self, offset, whence=0):
+        # Werkzeug rewinds file streams once the upload is parsed. We're write-only so there's nothing to do.
+        pass
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def commit(self):
+        """Moves the upload to its final location and returns its hash."""
+        self.close()
+        digest = self.hexdigest()
+        store(self.path, digest)
+
+        self.path = None
+        return digest
+
+    def discard(self):
+        """Removes the temporary file unless the upload was committed."""
+        self.close()
+
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                logging.exception('Failed to remove %s!', self.path)
+
+            self.path = None
+
+
+class UploadCollector(object):
+    """
+    Makes Werkzeug write uploaded files directly to HashedUpload objects.
+
+    Use it as a context manager around the code which accesses request.files.
+    All uploads which weren't committed are discarded at the end.
+    """
+    _request = None
+    uploads = None
+
+    def __init__(self, request):
+        self._request = request
+        self.uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashedUpload()
+        self.uploads.append(upload)
+        return upload
+
+    def __enter__(self):
+        # This replaces Werkzeug's default which spools the file to a temporary file or memory first.
+        self._request._get_file_stream = self._get_file_stream
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for upload in self.uploads:
+            upload.discard()
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChunkedUpload(object):
+    """
+    An upload which is sent in fixed-size chunks.
+
+    The chunks can arrive in any order and in parallel. Each one is written to
+    its place in a temporary file and recorded in Redis, so an interrupted
+    upload can be resumed by sending only the missing chunks. Once all chunks
+    are there, finish() verifies the file and moves it to its hash.
+
+    Redis keys: upload_<id> (hash with the upload's info) and upload_<id>_chunks
+    (set of the received chunk indexes). Both expire after UPLOAD_CHUNK_LIFETIME
+    seconds without activity. The temporary file is tracked in CHUNKED_FILES so
+    remove_stale() can remove it once the upload has been abandoned.
+
+    The upload ID is random and only known to the client which started the
+    upload, so it authorizes all requests after the first one.
+    """
+    id = None
+    info = None
+
+    def __init__(self, upload_id, info):
+        self.id = upload_id
+        self.info = info
+
+    @classmethod
+    def create(cls, filename, size, kid, sha256=None):
+        max_size = app.config.get('UPLOAD_MAX_SIZE', 4 * 1024**3)
+        if size <= 0 or size > max_size:
+            raise UploadError('Uploads have to be between 1 byte and %d bytes big!' % max_size)
+
+        chunk_size = app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024**2)
+        fd, path = tempfile.mkstemp(prefix='.chunked-', dir=upload_dir())
+        r.zadd(CHUNKED_FILES, time.time(), path)
+
+        with os.fdopen(fd, 'wb') as stream:
+            # Reserve the space now. (Most file systems create a sparse file.)
+            stream.truncate(size)
+
+        info = {
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'chunks': (size + chunk_size - 1) // chunk_size,
+            'kid': kid,
+            'sha256': sha256 or '',
+            'path': path,
+            'created': time.time()
+        }
+
+        upload = cls(binascii.hexlify(os.urandom(16)).decode('ascii'), info)
+        pipe = r.pipeline()
+        pipe.hmset(upload._key, info)
+        pipe.expire(upload._key, cls._lifetime())
+        pipe.execute()
+
+        return upload
+
+    @classmethod
+    def load(cls, upload_id):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id):
+            return None
+
+        info = r.hgetall('upload_' + upload_id)
+        if not info:
+            return None
+
+        info = dict((k.decode('utf8'), v.decode('utf8')) for k, v in info.items())
+        for field in ('size', 'chunk_size', 'chunks', 'kid'):
+            info[field] = int(info[field])
+
+        return cls(upload_id, info)
+
+    @staticmethod
+    def _lifetime():
+        return int(app.config.get('UPLOAD_CHUNK_LIFETIME', 24 * 60 * 60))
+
+    @property
+    def _key(self):
+        return 'upload_' + self.id
+
+    @property
+    def _chunks_key(self):
+        return 'upload_' + self.id + '_chunks'
+
+    def chunk_length(self, index):
+        if index == self.info['chunks'] - 1:
+            return self.info['size'] - index * self.info['chunk_size']
+
+        return self.info['chunk_size']
+
+    def missing(self):
+        received = set(int(i) for i in r.smembers(self._chunks_key))
+        return [i for i in range(self.info['chunks']) if i not in received]
+
+    def write_chunk(self, index, stream, sha256=None):
+        """Writes the chunk with the given index from the given stream. sha256 is checked if given."""
+        if index < 0 or index >= self.info['chunks']:
+            raise UploadError('Invalid chunk index!')
+
+        length = self.chunk_length(index)
+        chash = hashlib.new('sha256')
+        written = 0
+
+        with open(self.info['path'], 'r+b', BUFFER_SIZE) as dst:
+            dst.seek(index * self.info['chunk_size'])
+
+            while written < length:
+                data = stream.read(min(BUFFER_SIZE, length - written))
+                if not data:
+                    break
+
+                chash.update(data)
+                dst.write(data)
+                written += len(data)
+
+        # Make sure there's nothing left.
+        if written != length or stream.read(1):
+            raise UploadError('Chunk %d has to be exactly %d bytes long!' % (index, length))
+
+        if sha256 and chash.hexdigest() != sha256.lower():
+            raise UploadError('Chunk %d is corrupted!' % index)
+
+        pipe = r.pipeline()
+        pipe.sadd(self._chunks_key, index)
+        pipe.expire(self._chunks_key, self._lifetime())
+        pipe.expire(self._key, self._lifetime())
+        pipe.zadd(CHUNKED_FILES, time.time(), self.info['path'])
+        pipe.execute()
+
+    def finish(self):
+        """Verifies the completed upload, stores it and returns its hash."""
+        if self.missing():
+            raise UploadError('The upload is incomplete!')
+
+        # Make sure only one request finishes the upload.
+        if not r.hsetnx(self._key, 'finishing', '1'):
+            raise UploadError('The upload is already being finished!')
+
+        try:
+            digest = blobstore.hash_file(self.info['path'])
+            if self.info['sha256'] and digest != self.info['sha256'].lower():
+                self.discard()
+                raise UploadError('The uploaded file doesn\'t match the given hash!')
+
+            store(self.info['path'], digest)
+        except UploadError:
+            raise
+        except Exception:
+            r.hdel(self._key, 'finishing')
+            raise
+
+        r.delete(self._key, self._chunks_key)
+        r.zrem(CHUNKED_FILES, self.info['path'])
+        return digest
+
+    def discard(self):
+        r.delete(self._key, self._chunks_key)
+        r.zrem(CHUNKED_FILES, self.info['path'])
+
+        try:
+            os.unlink(self.info['path'])
+        except OSError:
+            logging.exception('Failed to remove %s!', self.info['path'])
+
+
+def remove_stale(limit=500):
+    """Removes up to limit temporary files of abandoned chunked uploads. Returns the number of removed files."""
+    cutoff = time.time() - ChunkedUpload._lifetime()
+    paths = r.zrangebyscore(CHUNKED_FILES, '-inf', cutoff, start=0, num=limit)
+
+    for path in paths:
+        try:
+            os.unlink(path.decode('utf8'))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                logging.exception('Failed to remove %s!', path)
+                continue
+
+        r.zrem(CHUNKED_FILES, path)
+
+    return len(paths)
@@ -1,6 +1,23 @@
+import json
+import hashlib
 from urllib.parse import urlparse, parse_qs
 
 
+def canonical_hash(data, *extra):
+    """
+    Return a SHA256 hex digest of the given JSON compatible data.
+
+    Key order and whitespace don't affect the result. Additional values can be
+    passed to make the hash depend on more than the data (i.e. configuration).
+    """
+    h = hashlib.sha256()
+    for item in (data,) + extra:
+        h.update(json.dumps(item, sort_keys=True, separators=(',', ':')).encode('utf8'))
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
 # This function has been adapted from redis.connection.ConnectionPool.from_url.
 # I changed it to return a dict which is compatible with tornadoredis.Client's keyword arguments.
 def parse_redis_url(url, db=None, **kwargs):
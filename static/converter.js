@@ -41,7 +41,8 @@
         });
 
         if(this.inter) {
-            this.on('captcha', function (image) {
+            // Fan-out tasks forward the captchas of their children. The response has to name the task which asked.
+            this.on('captcha', function (image, task_id) {
                 var win = $('<div>');
                 win.css({
                     position: 'fixed',
@@ -70,7 +71,7 @@
 
                 form.submit(function (e) {
                     e.preventDefault();
-                    self.emit('captcha_response', input.val());
+                    self.emit('captcha_response', input.val(), task_id);
                     win.remove();
                 });
 
@@ -98,6 +99,8 @@
 
         var _listeners = {};
         var _ws = null;
+        var _seq = null;
+        var _finished = false;
         var self = this;
 
         this.on = function (evt, cb) {
@@ -119,7 +122,8 @@
         this.connect = function () {
             var self = this;
 
-            _ws = new WebSocket(this.url);
+            // Only ask for the events we haven't seen yet if this is a reconnect.
+            _ws = new WebSocket(this.url + (_seq === null ? '' : '?since=' + encodeURIComponent(_seq)));
             if(this.inter) {
                 _ws.addEventListener('open', function () {
                     self.emit('user_ready');
@@ -128,11 +132,26 @@
             
             _ws.addEventListener('message', function (e) {
                 var data = JSON.parse(e.data);
+                if(data.length > 2) {
+                    _seq = data[2];
+                }
+
+                if(data[0] == 'done' || (data[0] == 'task_status' && data[1][0] == 'missing')) {
+                    _finished = true;
+                }
                 
                 $.each(_listeners[data[0]] || [], function (i, cb) {
                     cb.apply(null, data[1]);
                 });
             });
+
+            _ws.addEventListener('close', function () {
+                if(!_finished) {
+                    setTimeout(function () {
+                        self.connect();
+                    }, 2000);
+                }
+            });
         };
 
         this.bootstrap_ui = bootstrap_ui;
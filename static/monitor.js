@@ -1,37 +1,163 @@
 (function ($) {
-    function update_tasks() {
-        $.getJSON('/api/list_tasks', function (tasks) {
-            var tbody = $('table tbody');
-            var rows = $();
+    var PAGE_SIZE = 50;
+    var offset = 0;
+    var total = 0;
+    var tasks = [];
+    var ws = null;
+    var reconnect_timer = null;
 
-            if(tbody.length == 0) {
-                tbody = $('<tbody>').appendTo('table');
+    function ws_url() {
+        var url = location.href.replace(/^http(s?):\/\/([^\/]+)\/.*$/, 'ws$1://$2/').replace(':8080', ':8085');
+        var params = { limit: PAGE_SIZE };
+        var state = $('#state-filter').val();
+        if(state) {
+            params.state = state;
+        }
+
+        return url + 'ws/monitor?' + $.param(params);
+    }
+
+    function render() {
+        var tbody = $('table tbody');
+
+        if(tbody.length == 0) {
+            tbody = $('<tbody>').appendTo('table');
+        }
+
+        tbody.empty();
+
+        $.each(tasks, function (i, info) {
+            var runtime = info.runtime;
+            if(!runtime) {
+                runtime = new Date().getTime() / 1000 - info.time;
+            }
+
+            var row = $('<tr>').appendTo(tbody);
+            row.append($('<td>').text(info.id));
+            row.append($('<td>').text(info.state));
+            row.append($('<td>').text(Math.round(runtime) + 's'));
+            row.append($('<td>').text(new Date(info.time * 1000)));
+
+            row.click(function () {
+                location.href = '/watch/' + info.id;
+            });
+        });
+
+        var last = Math.min(offset + tasks.length, total);
+        $('#page-info').text((total ? offset + 1 : 0) + ' - ' + last + ' of ' + total);
+        $('#prev-page').prop('disabled', offset == 0);
+        $('#next-page').prop('disabled', last >= total);
+    }
+
+    function apply_update(msg) {
+        var state = $('#state-filter').val();
+        var pos = -1;
+
+        $.each(tasks, function (i, info) {
+            if(info.id == msg.id) {
+                pos = i;
+                return false;
+            }
+        });
+
+        if(pos > -1) {
+            tasks.splice(pos, 1);
+        }
+
+        if(msg.removed || (state && msg.status.state != state)) {
+            if(pos > -1) {
+                total--;
+            }
+        } else {
+            if(pos == -1) {
+                total++;
             }
 
-            tbody.empty();
+            // The task changed just now so it's the newest one.
+            tasks.unshift($.extend({ id: msg.id }, msg.status));
+            tasks = tasks.slice(0, PAGE_SIZE);
+        }
+
+        render();
+    }
+
+    function disconnect() {
+        clearTimeout(reconnect_timer);
+        reconnect_timer = null;
+
+        if(ws) {
+            ws.onclose = null;
+            ws.close();
+            ws = null;
+        }
+    }
+
+    function connect() {
+        disconnect();
+
+        // Only the first page is updated live.
+        ws = new WebSocket(ws_url());
+        ws.onmessage = function (e) {
+            var data = JSON.parse(e.data);
 
-            $.each(tasks, function (id, info) {
-                var runtime = info.runtime;
-                if(!runtime) {
-                    runtime = new Date().getTime() / 1000 - info.time;
+            if(data[0] == 'snapshot') {
+                tasks = data[1][0];
+                total = data[1][1];
+                render();
+            } else if(data[0] == 'update') {
+                apply_update(data[1][0]);
+            }
+        };
+        ws.onclose = function () {
+            ws = null;
+            reconnect_timer = setTimeout(function () {
+                reconnect_timer = null;
+
+                // The snapshot would replace whatever page the user switched to in the meantime.
+                if(offset == 0) {
+                    connect();
                 }
+            }, 5000);
+        };
+    }
 
-                var row = $('<tr>').appendTo(tbody);
-                row.append($('<td>').text(id));
-                row.append($('<td>').text(info.state));
-                row.append($('<td>').text(Math.round(runtime) + 's'));
-                row.append($('<td>').text(new Date(info.time * 1000)));
+    function load_page() {
+        if(offset == 0) {
+            connect();
+            return;
+        }
 
-                row.click(function () {
-                    location.href = '/watch/' + id;
-                });
-            });
+        disconnect();
+
+        var params = { offset: offset, limit: PAGE_SIZE };
+        var state = $('#state-filter').val();
+        if(state) {
+            params.state = state;
+        }
 
-            setTimeout(update_tasks, 10000);
+        $.getJSON('/api/list_tasks', params, function (data) {
+            tasks = data.tasks;
+            total = data.total;
+            render();
         });
     }
 
     $(function () {
-        update_tasks();
+        $('#state-filter').change(function () {
+            offset = 0;
+            load_page();
+        });
+        $('#prev-page').click(function () {
+            offset = Math.max(0, offset - PAGE_SIZE);
+            load_page();
+        });
+        $('#next-page').click(function () {
+            offset += PAGE_SIZE;
+            load_page();
+        });
+
+        // Keep the runtimes of running tasks up to date.
+        setInterval(render, 1000);
+        load_page();
     })
-})(jQuery);
\ No newline at end of file
+})(jQuery);
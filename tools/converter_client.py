@@ -26,6 +26,37 @@ import requests
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s@%(module)s] %(funcName)s %(levelname)s: %(message)s')
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'knossos'))
 
+# How long the server should wait for results before replying. (in seconds)
+WAIT_TIMEOUT = 60
+
+
+def poll_results(sess, server, ticket):
+    while True:
+        time.sleep(5)
+        try:
+            status = sess.get(server + ('/api/converter/get_status/%d' % ticket['ticket']))
+        except requests.ConnectionError:
+            logging.exception('Unable to determine status. I\'ll just wait a bit longer...')
+            continue
+
+        if status.status_code != 200:
+            logging.warning('Received an invalid reply! Are you sure this going as planned?')
+            return None
+
+        try:
+            status = status.json()
+            if status['state'] == 'DONE':
+                break
+        except ValueError:
+            logging.exception('Unable to determine status. I\'ll just wait a bit longer...')
+            continue
+
+    try:
+        return sess.post(server + '/api/converter/retrieve', data=ticket)
+    except requests.ConnectionError:
+        logging.exception('Failed to retrieve the results!')
+        return None
+
 
 def convert(src, dest, server, api_key):
     if not os.path.isfile(src):
@@ -59,30 +90,32 @@ def convert(src, dest, server, api_key):
 
     logging.info('Request sent. Waiting for results...')
     while True:
-        time.sleep(5)
         try:
-            status = sess.get(server + ('/api/converter/get_status/%d' % ticket['ticket']))
-        except requests.ConnectionError:
+            results = sess.post(server + '/api/converter/wait', data=dict(ticket, timeout=WAIT_TIMEOUT),
+                                timeout=WAIT_TIMEOUT + 30)
+        except (requests.ConnectionError, requests.Timeout):
             logging.exception('Unable to determine status. I\'ll just wait a bit longer...')
+            time.sleep(5)
             continue
 
-        if status.status_code != 200:
+        if results.status_code == 404:
+            # This server doesn't support waiting.
+            results = poll_results(sess, server, ticket)
+            if results is None:
+                return False
+
+            break
+
+        if results.status_code != 200:
             logging.warning('Received an invalid reply! Are you sure this going as planned?')
             return False
 
         try:
-            status = status.json()
-            if status['state'] == 'DONE':
+            if results.json()['finished']:
                 break
         except ValueError:
             logging.exception('Unable to determine status. I\'ll just wait a bit longer...')
-            continue
-
-    try:
-        results = sess.post(server + '/api/converter/retrieve', data=ticket)
-    except requests.ConnectionError:
-        logging.exception('Failed to retrieve the results!')
-        return False
+            time.sleep(5)
 
     results = results.json()
     if not results['finished']:
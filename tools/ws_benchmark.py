@@ -0,0 +1,119 @@
+#!/usr/bin/python
+## Copyright 2015 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+# Measures how fast websocket_server.py delivers task events to many watchers of the same task.
+# Start the WebSocket server first. Large watcher counts might need a higher file descriptor limit (ulimit -n).
+
+from __future__ import absolute_import, print_function, division
+
+import os.path
+import sys
+import argparse
+import logging
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s@%(module)s] %(funcName)s %(levelname)s: %(message)s')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado import ioloop, gen, websocket
+
+from slib.central import app, r
+from slib import registry
+
+
+def publish(task_id, count):
+    stream_mode = app.config.get('TASK_EVENT_STORE', 'list') == 'stream'
+    pipe = r.pipeline(transaction=False)
+
+    # Progress events are conflated by the server so we have to use log messages (which are delivered one by one).
+    for i in range(count):
+        data = json.dumps(('log_message', ('Benchmark %d' % i,)))
+        if stream_mode:
+            pipe.execute_command('XADD', 'task_%d_events' % task_id, '*', 'n', 'log_message', 'd', data, 'v', '0')
+        else:
+            pipe.publish('task_%d' % task_id, data)
+
+        if len(pipe) >= 1000:
+            pipe.execute()
+
+    pipe.execute()
+
+
+@gen.coroutine
+def receive(conn, count):
+    received = 0
+    while received < count:
+        msg = yield conn.read_message()
+        if msg is None:
+            raise Exception('The server closed the connection!')
+
+        msg = json.loads(msg)
+        if msg[0] == 'log_message' and msg[1][0].startswith('Benchmark '):
+            received += 1
+
+
+@gen.coroutine
+def run(url, task_id, watchers, count):
+    conns = []
+    for i in range(watchers):
+        conn = yield websocket.websocket_connect(url)
+        conns.append(conn)
+
+    # Give the server some time to finish the replays.
+    yield gen.Task(ioloop.IOLoop.current().add_timeout, time.time() + 1)
+
+    readers = [receive(conn, count) for conn in conns]
+    start = time.time()
+
+    with ThreadPoolExecutor(1) as pool:
+        yield pool.submit(publish, task_id, count)
+
+    yield readers
+    duration = time.time() - start
+
+    for conn in conns:
+        conn.close()
+
+    raise gen.Return(duration)
+
+
+@gen.coroutine
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmarks the WebSocket server.')
+    parser.add_argument('--server', default='ws://%s:%d/' % tuple(app.config['WS_LISTEN']))
+    parser.add_argument('--watchers', default='1,100,1000', help='a comma separated list of watcher counts')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='the number of messages to send in each run (keep this below WS_QUEUE_LIMIT)')
+    parser.add_argument('--task', type=int, default=999999999, help='the ID of the (fake) task to watch')
+    args = parser.parse_args(args)
+
+    url = args.server.rstrip('/') + '/ws/watcher/%d' % args.task
+    registry.set_status(args.task, {'state': 'WORKING', 'time': time.time()})
+
+    try:
+        for watchers in [int(n) for n in args.watchers.split(',')]:
+            logging.info('Running with %d watchers...', watchers)
+            duration = yield run(url, args.task, watchers, args.messages)
+
+            print('%5d watchers: %8.1f messages/s, %10.1f deliveries/s (%.2fs)' % (
+                watchers, args.messages / duration, args.messages * watchers / duration, duration))
+    finally:
+        registry.remove(args.task)
+
+
+if __name__ == '__main__':
+    ioloop.IOLoop.instance().run_sync(lambda: main(sys.argv[1:]))
@@ -17,36 +17,172 @@ from __future__ import absolute_import, print_function
 import logging
 import sys
 import os
+import time
 import functools
+import datetime
+from collections import OrderedDict, deque
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s@%(module)s] %(funcName)s %(levelname)s: %(message)s')
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'knossos'))
 
 import tornadoredis
 from tornado import ioloop, web, websocket, gen
+from tornado.concurrent import Future
 from flask import json
 
-from slib.central import app, r
+from slib.central import app
+from slib import registry
 from slib.util import parse_redis_url
 
 redis_sub = None
+redis_cmd = None
+redis_tail = None
 watchers = {}
 
+# In stream mode, the task events are read from Redis Streams instead of pubsub. stream_cursors contains the last ID
+# we've read from each stream (None if the first watcher is still replaying the stream's history).
+STREAM_MODE = app.config.get('TASK_EVENT_STORE', 'list') == 'stream'
+stream_cursors = {}
+stream_added = None
+
+# Connections which have queued messages (see BaseHandler).
+pending_clients = set()
+
+
+def _str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def _bytes(value):
+    return value.encode('utf8') if not isinstance(value, bytes) else value
+
+
+def parse_stream_id(eid):
+    ms, seq = eid.split('-')
+    return int(ms), int(seq)
+
+
+def parse_stream_entry(fields):
+    fields = [_str(f) for f in fields]
+    return dict(zip(fields[::2], fields[1::2]))
+
+
+@gen.coroutine
+def tail_streams():
+    global stream_added
+
+    while True:
+        cursors = [(name, cursor) for name, cursor in stream_cursors.items() if cursor is not None]
+        if len(cursors) == 0:
+            stream_added = Future()
+            yield stream_added
+            continue
+
+        args = ['XREAD', 'BLOCK', 500, 'STREAMS'] + [c[0] for c in cursors] + [c[1] for c in cursors]
+        try:
+            reply = yield gen.Task(redis_tail.execute_command, *args)
+            if isinstance(reply, Exception):
+                raise reply
+        except Exception:
+            logging.exception('Failed to read task events!')
+            yield gen.Task(ioloop.IOLoop.current().add_timeout, datetime.timedelta(seconds=1))
+            continue
+
+        for name, entries in reply or []:
+            name = _str(name)
+            if name not in stream_cursors:
+                # Nobody is watching anymore.
+                continue
+
+            task = name[:-len('_events')]
+            for eid, fields in entries:
+                eid = _str(eid)
+                stream_cursors[name] = eid
+                entry = parse_stream_entry(fields)
+
+                # Build the frame once and send the same bytes to every watcher.
+                if entry.get('v') == '1':
+                    frame = _bytes(entry['d'])
+                else:
+                    # The stream ID is the sequence number of log events.
+                    frame = _bytes('%s,"%s"]' % (entry['d'][:-1], eid))
+
+                for w in list(watchers.get(task, ())):
+                    w(frame, eid)
+
+
+@gen.coroutine
+def call(method, *args, **kwargs):
+    """
+    Runs a tornadoredis method and returns its reply.
+
+    The synchronous client from slib.central must not be used here since it
+    would block the IOLoop (and therefore every other connection).
+    """
+    reply = yield gen.Task(method, *args, **kwargs)
+    if isinstance(reply, Exception):
+        raise reply
+
+    raise gen.Return(reply)
+
+
+def parse_status(data):
+    if data is None:
+        return None
+
+    return json.loads(_str(data))
+
+
+@gen.coroutine
+def get_status(task_id):
+    data = yield call(redis_cmd.get, registry.status_key(task_id))
+    raise gen.Return(parse_status(data))
+
+
+@gen.coroutine
+def query_tasks(state=None, limit=50):
+    """The non-blocking version of registry.query()."""
+    name = registry.INDEX if state is None else 'task_state_' + state
+
+    pipe = redis_cmd.pipeline()
+    pipe.zcount(name, '-inf', '+inf')
+    pipe.zrevrangebyscore(name, '+inf', '-inf', offset=0, limit=limit)
+    total, task_ids = yield call(pipe.execute)
+
+    tasks = []
+    if task_ids:
+        task_ids = [_str(t) for t in task_ids]
+        statuses = yield call(redis_cmd.mget, [registry.status_key(t) for t in task_ids])
+
+        for task_id, data in zip(task_ids, statuses):
+            if data is not None:
+                tasks.append((task_id, parse_status(data)))
+
+    raise gen.Return((int(total), tasks))
+
+
+def activate_stream(task, cursor):
+    """Starts tailing the task's stream at the given cursor unless it's already tailed. Returns the current cursor."""
+    name = 'task_' + str(task) + '_events'
+    if stream_cursors.get(name, '') is None:
+        stream_cursors[name] = cursor
+
+        if stream_added and not stream_added.done():
+            stream_added.set_result(None)
+
+    return stream_cursors.get(name)
+
 
 def redis_listener(msg):
     global watchers
 
     if msg.kind == 'message':
-        try:
-            data = json.loads(msg.body)
-        except ValueError:
-            logging.exception('Received invalid JSON from Redis!')
-            return
+        # The payload is forwarded as is. Encoding it here means all watchers share the same bytes.
+        frame = _bytes(msg.body)
 
-        task = msg.channel
-        if task in watchers:
-            for w in watchers[task]:
-                w(data)
+        if msg.channel in watchers:
+            for w in watchers[msg.channel]:
+                w(frame)
     elif msg.kind == 'disconnect':
         # Disconnected from the server.
         # TODO: Should we try to reconnect?
@@ -56,16 +192,15 @@ def redis_listener(msg):
 
 
 @gen.coroutine
-def subscribe_task(task, cb):
+def subscribe_channel(channel, cb):
     global watchers
-    task = 'task_' + str(task)
     need_sub = not redis_sub.subscribed
 
-    if task not in watchers:
-        watchers[task] = [cb]
-        yield gen.Task(redis_sub.subscribe, task)
+    if channel not in watchers:
+        watchers[channel] = [cb]
+        yield gen.Task(redis_sub.subscribe, channel)
     else:
-        watchers[task].append(cb)
+        watchers[channel].append(cb)
 
     if need_sub:
         logging.debug('Starting Redis listener...')
@@ -73,74 +208,346 @@ def subscribe_task(task, cb):
         logging.debug('Lets go on...')
 
 
+@gen.coroutine
+def unsubscribe_channel(channel, cb):
+    global watchers
+
+    watchers[channel].remove(cb)
+    if len(watchers[channel]) == 0:
+        del watchers[channel]
+        yield gen.Task(redis_sub.unsubscribe, channel)
+
+
+@gen.coroutine
+def subscribe_task(task, cb):
+    global watchers
+    task = 'task_' + str(task)
+
+    if STREAM_MODE:
+        watchers.setdefault(task, []).append(cb)
+        # The first watcher has to tell us where to start (see activate_stream).
+        stream_cursors.setdefault(task + '_events', None)
+    else:
+        yield subscribe_channel(task, cb)
+
+
 @gen.coroutine
 def unsubscribe_task(task, cb):
     global watchers
     task = 'task_' + str(task)
 
-    watchers[task].remove(cb)
-    if len(watchers[task]) == 0:
-        del watchers[task]
-        yield gen.Task(redis_sub.unsubscribe, task)
+    if STREAM_MODE:
+        watchers[task].remove(cb)
+        if len(watchers[task]) == 0:
+            del watchers[task]
+            stream_cursors.pop(task + '_events', None)
+    else:
+        yield unsubscribe_channel(task, cb)
 
 
-class WatchHandler(websocket.WebSocketHandler):
-    _task_id = None
-    _pinger = None
+def drain_queues():
+    for client in list(pending_clients):
+        if not client.flush_queue():
+            pending_clients.discard(client)
+
+
+class BaseHandler(websocket.WebSocketHandler):
+    """
+    Queues live messages so a slow client can't fill up our memory.
+
+    A message is written once the connection's write buffer is empty. Only the
+    latest progress event is kept, and at most WS_QUEUE_LIMIT other messages.
+    If the queue overflows, new messages are dropped and the client is
+    disconnected once it has caught up (or after WS_SLOW_CLIENT_TIMEOUT
+    seconds). Watchers then reconnect and resume where they left off.
+    """
+    buffered_bytes = 0
+    dropped = 0
+    _queue = None
+    _progress = None
+    _overflow = None
 
     def check_origin(self, origin):
         return True
 
+    def send(self, frame):
+        frame = _bytes(frame)
+        if self._queue is None:
+            self._queue = deque()
+
+        if frame.startswith(b'["progress"'):
+            # Only the latest progress matters.
+            if self._progress is not None:
+                self.buffered_bytes -= len(self._progress)
+                self.dropped += 1
+
+            self._progress = frame
+        elif self._overflow is not None:
+            self.dropped += 1
+            return
+        elif len(self._queue) >= app.config.get('WS_QUEUE_LIMIT', 1000):
+            logging.warning('Client %s is too slow, dropping messages.', self.request.remote_ip)
+            self._overflow = time.time()
+            self.dropped += 1
+            return
+        else:
+            self._queue.append(frame)
+
+        self.buffered_bytes += len(frame)
+        if self.flush_queue():
+            pending_clients.add(self)
+
+    def flush_queue(self):
+        """Writes as many queued messages as possible and returns True if some are still waiting."""
+        if self.ws_connection is None or self.stream.closed():
+            return False
+
+        while not self.stream.writing():
+            if self._queue:
+                frame = self._queue.popleft()
+            elif self._progress is not None:
+                frame = self._progress
+                self._progress = None
+            else:
+                break
+
+            self.buffered_bytes -= len(frame)
+            self.write_message(frame)
+
+        pending = bool(self._queue) or self._progress is not None
+        if self._overflow is not None:
+            if not pending or time.time() - self._overflow > app.config.get('WS_SLOW_CLIENT_TIMEOUT', 30):
+                self.close()
+                return False
+
+        return pending
+
+    def on_close(self):
+        pending_clients.discard(self)
+        self._queue = self._progress = None
+
+        if self.dropped > 0:
+            logging.info('Client %s disconnected. %d messages were dropped.', self.request.remote_ip, self.dropped)
+
+    def get_compression_options(self):
+        # Enables permessage-deflate if the client supports it.
+        if app.config.get('WS_COMPRESSION', False):
+            return {}
+
+        return None
+
+
+class WatchHandler(BaseHandler):
+    """
+    Sends the task's stored events followed by every new event.
+
+    Log events carry a sequence number as their third element. A client which
+    reconnects can pass the last one it received as the "since" query parameter
+    to skip the events it already has.
+
+    The replayed history is written directly since its size is limited, only
+    new events go through the queue.
+    """
+    _task_id = None
+    _pinger = None
+    _listener = None
+    _last_id = None
+    _last_seq = 0
+    _backlog = None
+    _closed = False
+
     @gen.coroutine
     def open(self, task):
         self._task_id = int(task)
         self._pinger = ioloop.PeriodicCallback(functools.partial(self.ping, b' '), 5000)
         self._pinger.start()
 
-        if not r.hexists('task_status', self._task_id):
+        status = yield get_status(self._task_id)
+        if self._closed:
+            return
+
+        if status is None:
             self._process_message(('task_status', ('missing',)))
             self._log('The requested task is missing!')
             return
 
-        yield subscribe_task(self._task_id, self._process_message)
+        if 'follows' in status and status['state'] != 'DONE':
+            # This ticket shares its work with another task. Show that task instead.
+            self._task_id = status['follows']
+
+        since = self.get_argument('since', None)
+        if STREAM_MODE:
+            yield self._replay_stream(since)
+        else:
+            yield self._replay_list(since)
+
+    @gen.coroutine
+    def _replay_list(self, since):
+        try:
+            self._last_seq = max(0, int(since or 0))
+        except ValueError:
+            self._last_seq = 0
+
+        # Messages which arrive while we're replaying the history are kept in the backlog.
+        self._backlog = []
+        if not (yield self._subscribe(self._process_list_message)):
+            return
 
-        # Deliver all stored log entries.
-        log_name = 'task_' + task + '_log'
-        log_entries = r.lrange(log_name, 0, r.llen(log_name))
+        # Fetch everything we need in one round trip.
+        task = 'task_%d' % self._task_id
+        pipe = redis_cmd.pipeline()
+        pipe.lrange(task + '_log', self._last_seq, -1)
+        pipe.hgetall(task + '_vlog')
+        pipe.get(registry.status_key(self._task_id))
+        log_entries, vlog, status = yield call(pipe.execute)
+        if self._closed:
+            return
 
         for entry in log_entries:
-            self.write_message(entry)
+            self._last_seq += 1
+            self.write_message('%s,%d]' % (_str(entry)[:-1], self._last_seq))
+
+        for data in (vlog or {}).values():
+            self.write_message(_str(data))
 
-        vlog_name = 'task_' + task + '_vlog'
-        for key in r.hkeys(vlog_name):
-            self.write_message(r.hget(vlog_name, key))
+        backlog = self._backlog
+        self._backlog = None
 
-        if len(log_entries) == 0:
+        for frame in backlog:
             try:
-                status = json.loads(r.hget('task_status', self._task_id))
-            except:
-                logging.exception('Failed to load status for task #%d.' % self._task_id)
+                seq = json.loads(_str(frame))[2:]
+            except ValueError:
+                seq = None
+
+            # Skip log events we've already sent during the replay.
+            if not seq or seq[0] > self._last_seq:
+                self.send(frame)
+
+        status = parse_status(status)
+        if self._last_seq == 0 and status and status['state'] == 'WAITING':
+            self._log('The task is queued, please wait...')
+
+    def _process_list_message(self, frame):
+        if self._backlog is not None:
+            self._backlog.append(frame)
+        else:
+            # Pubsub delivers messages in order so everything after the replay is new.
+            self.send(frame)
+
+    @gen.coroutine
+    def _replay_stream(self, since):
+        if since:
+            try:
+                parse_stream_id(since)
+            except ValueError:
+                since = None
+
+        self._last_id = since
+
+        # Messages which arrive while we're replaying the history are kept in the backlog.
+        self._backlog = []
+        if not (yield self._subscribe(self._process_stream_message)):
+            return
+
+        replayed = yield self._replay_range('+')
+        if self._closed:
+            return
+
+        # If another watcher started tailing this stream while we were replaying, the tailer might have started after
+        # the last entry we've read. Fetch the entries in between. The backlog contains everything after the cursor.
+        cursor = activate_stream(self._task_id, self._last_id or '0-0')
+        if cursor and cursor != '0-0' and (self._last_id is None or
+                                           parse_stream_id(cursor) > parse_stream_id(self._last_id)):
+            replayed = (yield self._replay_range(cursor)) or replayed
+            if self._closed:
+                return
+
+        backlog = self._backlog
+        self._backlog = None
+
+        for data, eid in backlog:
+            self._process_stream_message(data, eid)
+
+        if not replayed and not since:
+            status = yield get_status(self._task_id)
+            if not self._closed and status and status['state'] == 'WAITING':
+                self._log('The task is queued, please wait...')
+
+    @gen.coroutine
+    def _subscribe(self, listener):
+        """Subscribes the listener to the task. Returns False if the client left in the meantime."""
+        if self._closed:
+            raise gen.Return(False)
+
+        yield subscribe_task(self._task_id, listener)
+        if self._closed:
+            # on_close() didn't know about the subscription.
+            yield unsubscribe_task(self._task_id, listener)
+            raise gen.Return(False)
+
+        self._listener = listener
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _replay_range(self, end):
+        """Sends the stored events after self._last_id up to end. Returns True if there were any."""
+        start = self._last_id
+        entries = yield call(redis_cmd.execute_command, 'XRANGE', 'task_%d_events' % self._task_id, start or '-', end)
+        if self._closed:
+            raise gen.Return(False)
+
+        volatile = OrderedDict()
+        replayed = False
+
+        for eid, fields in entries or []:
+            eid = _str(eid)
+            if eid == start:
+                # XRANGE includes the start ID but the client already has that event.
+                continue
+
+            self._last_id = eid
+            replayed = True
+            entry = parse_stream_entry(fields)
+
+            if entry.get('v') == '1':
+                # Only the latest volatile event of each kind is relevant.
+                volatile[entry['n']] = entry['d']
             else:
-                if status['state'] == 'WAITING':
-                    self._log('The task is queued, please wait...')
+                self.write_message('%s,"%s"]' % (entry['d'][:-1], eid))
+
+        for data in volatile.values():
+            self.write_message(data)
+
+        raise gen.Return(replayed)
+
+    def _process_stream_message(self, frame, eid):
+        if self._backlog is not None:
+            self._backlog.append((frame, eid))
+        elif self._last_id is None or parse_stream_id(eid) > parse_stream_id(self._last_id):
+            self._last_id = eid
+            self.send(frame)
 
     def on_message(self, msg):
         pass
 
     @gen.coroutine
     def on_close(self):
+        super(WatchHandler, self).on_close()
+        self._closed = True
         self._pinger.stop()
-        yield unsubscribe_task(self._task_id, self._process_message)
+        if self._listener:
+            yield unsubscribe_task(self._task_id, self._listener)
 
     def _log(self, msg):
         self._process_message(('log_message', (msg,)))
 
     def _process_message(self, msg):
-        self.write_message(json.dumps(msg))
+        self.send(json.dumps(msg))
 
 
 class InteractiveHandler(WatchHandler):
 
+    @gen.coroutine
     def on_message(self, msg):
         # Make sure the JSON data is valid.
         try:
@@ -149,17 +556,89 @@ class InteractiveHandler(WatchHandler):
             logging.exception('Received invalid JSON!')
             return
 
-        r.publish('task_' + str(self._task_id) + '_input', msg)
+        try:
+            yield call(redis_cmd.publish, 'task_' + str(self._task_id) + '_input', msg)
+        except Exception:
+            logging.exception('Failed to forward input to task #%d!' % self._task_id)
+
+
+class MonitorHandler(BaseHandler):
+    """
+    Sends a snapshot of the newest tasks followed by every status change.
+
+    The snapshot can be filtered with the "state" and "limit" query parameters.
+    Updates aren't filtered, the client decides what to show.
+    """
+    _pinger = None
+    _subscribed = False
+    _closed = False
+
+    @gen.coroutine
+    def open(self):
+        self._pinger = ioloop.PeriodicCallback(functools.partial(self.ping, b' '), 5000)
+        self._pinger.start()
+
+        state = self.get_argument('state', None)
+        if state not in registry.STATES:
+            state = None
+
+        try:
+            limit = min(max(1, int(self.get_argument('limit', 50))), 500)
+        except ValueError:
+            limit = 50
+
+        # Subscribe first so we don't miss any changes. The client can handle updates for tasks it doesn't know.
+        yield subscribe_channel(registry.LIFECYCLE, self._process_message)
+        if self._closed:
+            # The client left while we were subscribing. on_close() didn't know about the subscription.
+            yield unsubscribe_channel(registry.LIFECYCLE, self._process_message)
+            return
+
+        self._subscribed = True
+
+        total, tasks = yield query_tasks(state, limit)
+        if self._closed:
+            return
+
+        snapshot = []
+        for task_id, info in tasks:
+            info['id'] = int(task_id)
+            snapshot.append(info)
+
+        self.write_message(json.dumps(('snapshot', (snapshot, total))))
+
+    @gen.coroutine
+    def on_close(self):
+        super(MonitorHandler, self).on_close()
+        self._closed = True
+        self._pinger.stop()
+        if self._subscribed:
+            yield unsubscribe_channel(registry.LIFECYCLE, self._process_message)
+
+    def _process_message(self, frame):
+        # Wrap the raw status update instead of decoding and encoding it again.
+        self.send(b'["update",[' + frame + b']]')
 
 
 if __name__ == '__main__':
     redis_sub = tornadoredis.Client(**parse_redis_url(app.config['REDIS']))
+    redis_cmd = tornadoredis.Client(**parse_redis_url(app.config['REDIS']))
+    redis_cmd.connect()
+
+    if STREAM_MODE:
+        # XREAD blocks the connection so the tailer needs its own.
+        redis_tail = tornadoredis.Client(**parse_redis_url(app.config['REDIS']))
+        redis_tail.connect()
+        ioloop.IOLoop.instance().add_callback(tail_streams)
+
     application = web.Application([
         (r'/ws/watcher/(\d+)', WatchHandler),
-        (r'/ws/inter/(\d+)', InteractiveHandler)
+        (r'/ws/inter/(\d+)', InteractiveHandler),
+        (r'/ws/monitor', MonitorHandler)
     ])
     
     application.listen(app.config['WS_LISTEN'][1], app.config['WS_LISTEN'][0])
+    ioloop.PeriodicCallback(drain_queues, 50).start()
 
     logging.info('Ready.')
     try: